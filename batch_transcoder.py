@@ -3,10 +3,28 @@ import subprocess
 import sys
 import time
 import configparser
-import shutil
+import threading
+import hashlib
+import socket
+from concurrent.futures import wait as wait_for_futures
+from datetime import datetime, timedelta
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from colorama import Fore, Style
 from colorama import init
 init(autoreset=True)
+from job_state import JobStateStore, SegmentCheckpoint, done_statuses
+from media_probe import ProbeCache, ProbeError
+from scheduler import BatchEta, ThroughputModel, choose_preset, closest_presets, job_orders, nvenc_presets, order_jobs, preset_order
+from segment_encoder import encode_in_segments, partial_path
+from copy_engine import fast_copy
+from encode_progress import ProgressTracker, run_ffmpeg
+from phase_timer import PhaseTimer, ThreadProfiler
+from size_predictor import predict_output, predicted_savings
+from scratch_staging import ScratchStaging
+from shared_queue import LeaseQueue
+from resource_governor import NotEnoughSpaceError, ResourceGovernor, x265_pools
+from duplicate_finder import find_duplicates
+from output_verifier import verify_output
 
 # Get path to settings.cfg file
 config = configparser.ConfigParser()
@@ -32,12 +50,87 @@ encoder = config.get('Codecs', 'encoder')
 speed_preset = config.get('Transcoding settings', 'speed_preset')
 crf_quality = config.get('Transcoding settings', 'crf_quality')
 
+# Access variables in the Concurrency section (optional, defaults to one file at a time)
+max_jobs = config.getint('Concurrency', 'max_jobs', fallback=1)
+threads_per_job = config.getint('Concurrency', 'threads_per_job', fallback=0)
+max_cpu_jobs = config.getint('Concurrency', 'max_cpu_jobs', fallback=0)
+max_nvenc_jobs = config.getint('Concurrency', 'max_nvenc_jobs', fallback=0)
+streaming = config.getboolean('Concurrency', 'streaming', fallback=False)
+queue_size = config.getint('Concurrency', 'queue_size', fallback=0)
+scan_workers = config.getint('Scan', 'scan_workers', fallback=8)  # Also the number of files probed at once while planning
+
+# Access variables in the Resources section (optional). Keeps parallel jobs within the CPU, memory and disk headroom.
+adaptive_jobs = config.getboolean('Resources', 'adaptive_jobs', fallback=False)
+max_cpu_percent = config.getfloat('Resources', 'max_cpu_percent', fallback=95.0)
+min_free_memory_mb = config.getint('Resources', 'min_free_memory_mb', fallback=1024)
+min_free_space_gb = config.getfloat('Resources', 'min_free_space_gb', fallback=1.0)
+resource_sample_seconds = config.getint('Resources', 'sample_seconds', fallback=5)
+
+# Access variables in the Segments section (optional). Large files can be split and encoded by several ffmpeg processes.
+segment_encoding = config.getboolean('Segments', 'segment_encoding', fallback=False)
+segment_min_size_gb = config.getfloat('Segments', 'segment_min_size_gb', fallback=10.0)
+segment_seconds = config.getint('Segments', 'segment_seconds', fallback=120)
+segment_workers = config.getint('Segments', 'segment_workers', fallback=4)
+checkpoint_min_minutes = config.getfloat('Segments', 'checkpoint_min_minutes', fallback=0)
+
+# Access variables in the Staging section (optional). Inputs on a network share can be copied to a local drive first.
+staging_enabled = config.getboolean('Staging', 'staging', fallback=False)
+scratch_folder = config.get('Staging', 'scratch_folder', fallback="").strip()
+scratch_budget_gb = config.getfloat('Staging', 'scratch_budget_gb', fallback=100)
+prefetch_files = config.getint('Staging', 'prefetch_files', fallback=2)
+
+# Access variables in the Distributed section (optional). Several nodes can work through the same files together.
+shared_queue = config.getboolean('Distributed', 'shared_queue', fallback=False)
+queue_folder = config.get('Distributed', 'queue_folder', fallback="").strip()
+node_name = config.get('Distributed', 'node_name', fallback="").strip() or f"{socket.gethostname()}-{os.getpid()}"
+lease_seconds = config.getint('Distributed', 'lease_seconds', fallback=120)
+heartbeat_seconds = config.getint('Distributed', 'heartbeat_seconds', fallback=30)
+
+# Access variables in the Scheduling section (optional)
+job_order = config.get('Scheduling', 'job_order', fallback="list").strip().lower()
+deadline_setting = config.get('Scheduling', 'deadline', fallback="").strip()
+min_fps = config.getfloat('Scheduling', 'min_fps', fallback=0)
+fastest_preset = config.get('Scheduling', 'fastest_preset', fallback="veryfast").strip().lower()
+slowest_preset = config.get('Scheduling', 'slowest_preset', fallback="").strip().lower() or speed_preset
+
+# Access variables in the Size prediction section (optional)
+predict_size = config.getboolean('Size prediction', 'predict_size', fallback=False)
+prediction_samples = config.getint('Size prediction', 'prediction_samples', fallback=3)
+prediction_sample_seconds = config.getint('Size prediction', 'prediction_sample_seconds', fallback=10)
+min_savings_percent = config.getfloat('Size prediction', 'min_savings_percent', fallback=10)
+unprofitable_files = config.get('Size prediction', 'unprofitable_files', fallback="skip").strip().lower()
+
+# Access variables in the Duplicates section (optional). Identical files in several folders are transcoded once.
+detect_duplicates = config.getboolean('Duplicates', 'detect_duplicates', fallback=False)
+link_duplicates = config.getboolean('Duplicates', 'link_duplicates', fallback=True)
+hash_workers = config.getint('Duplicates', 'hash_workers', fallback=4)
+
+# Access variables in the Verification section (optional). Outputs are checked before they count as completed.
+verify_outputs = config.getboolean('Verification', 'verify_outputs', fallback=False)
+verify_workers = config.getint('Verification', 'verify_workers', fallback=2)
+verify_samples = config.getint('Verification', 'verify_samples', fallback=3)
+verify_sample_seconds = config.getint('Verification', 'verify_sample_seconds', fallback=5)
+verify_retries = config.getint('Verification', 'verify_retries', fallback=1)
+
+# Access variables in the Monitoring section (optional)
+write_events = config.getboolean('Monitoring', 'write_events', fallback=True)
+write_metrics = config.getboolean('Monitoring', 'write_metrics', fallback=True)
+metrics_interval = config.getint('Monitoring', 'metrics_interval', fallback=10)
+console_interval = config.getint('Monitoring', 'console_interval', fallback=30)
+
+# Access variables in the Profiling section (optional)
+timing_report = config.getboolean('Profiling', 'timing_report', fallback=True)
+profile_run = config.getboolean('Profiling', 'profile', fallback=False)
+slowest_files = config.getint('Profiling', 'slowest_files', fallback=10)
+
 # Access variables in the Other settings section
 copy_files_of_wrong_codec = config.getboolean('Other', 'copy_files_of_wrong_codec')
 verbose_information = config.getboolean('Other', 'verbose_information')
 
 use_different_extension = config.getboolean('Other', 'use_different_extension')
 output_extension = config.get('Other', 'output_extension')
+remux_wrong_codec_files = config.getboolean('Other', 'remux_wrong_codec_files', fallback=False)
+use_hardlinks = config.getboolean('Other', 'use_hardlinks', fallback=True)
 
 if (verbose_information):
     loglevel = "verbose"
@@ -46,13 +139,26 @@ else:
 
 # Set paths
 files_list_path = os.path.join(script_folder, input_files_list_name)
+job_state_path = os.path.join(script_folder, "job_state.db")
+segments_folder = os.path.join(script_folder, "segments")
+samples_folder = os.path.join(script_folder, "samples")
+scratch_folder = scratch_folder or os.path.join(script_folder, "scratch")
+queue_folder = queue_folder or os.path.join(output_base_folder, ".transcode_queue")  # Reachable by every node
+events_path = os.path.join(script_folder, "encode_events.jsonl")
+metrics_path = os.path.join(script_folder, "metrics.prom")
+probe_cache_path = os.path.join(script_folder, "probe_cache.db")
+timing_report_path = os.path.join(script_folder, "timing_report.txt")
+profile_path = os.path.join(script_folder, "batch_transcoder.pstats")
+
+# Text files used by older versions, imported into job_state.db once
 completed_files_path = os.path.join(script_folder, "completed_files.txt")
 error_files_path = os.path.join(script_folder, "error_files.txt")
 wrong_codec_files_path = os.path.join(script_folder, "wrong_codec_files.txt")
 
 video_extensions = (".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv")
 
-# Adjust encoder for FFMPEG
+# Adjust encoder for FFMPEG. Several encoders can be listed (e.g. "x265, x265_NVenc") to keep both
+# the CPU and the GPU busy, each job then uses the first listed encoder that has a free slot.
 encoder = encoder.strip().lower()
 encoder_mapping = {
     "x264": "libx264",
@@ -60,10 +166,15 @@ encoder_mapping = {
     "x265": "libx265",
     "x265_nvenc": "h265_nvenc"
 }
-ffmpeg_encoder = encoder_mapping.get(encoder)
-if ffmpeg_encoder is None:
-    print("Error: Invalid encoder specified in settings.cfg. Exiting.")
-    sys.exit()
+ffmpeg_encoders = []
+for encoder_name in encoder.split(","):
+    mapped_encoder = encoder_mapping.get(encoder_name.strip())
+    if mapped_encoder is None:
+        print("Error: Invalid encoder specified in settings.cfg. Exiting.")
+        sys.exit()
+    if mapped_encoder not in ffmpeg_encoders:
+        ffmpeg_encoders.append(mapped_encoder)
+ffmpeg_encoder = ffmpeg_encoders[0]
 
 # Adjust input codec for FFMPEG
 input_codec = input_codec.strip().lower()
@@ -103,14 +214,130 @@ except ValueError:  # Handle non-integer values
     print("Error: crf_quality must be an integer in settings.cfg. Exiting.")
     sys.exit()
 
+if job_order not in job_orders:
+    print("Error: Invalid job_order specified in settings.cfg. Exiting.")
+    sys.exit()
+
+def parse_deadline(value):
+    """Return the deadline as a timestamp. A time without a date means the next time the clock shows it."""
+    for date_format in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, date_format).timestamp()
+        except ValueError:
+            pass
+    clock = datetime.strptime(value, "%H:%M")
+    now = datetime.now()
+    next_time = now.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+    if next_time <= now:
+        next_time += timedelta(days=1)
+    return next_time.timestamp()
+
+deadline = None
+if deadline_setting:
+    try:
+        deadline = parse_deadline(deadline_setting)
+    except ValueError:
+        print("Error: Invalid deadline specified in settings.cfg (use YYYY-MM-DD HH:MM or HH:MM). Exiting.")
+        sys.exit()
+
+if (fastest_preset not in preset_order or slowest_preset not in preset_order
+        or preset_order.index(fastest_preset) > preset_order.index(slowest_preset) or min_fps < 0):
+    print("Error: Invalid fastest_preset, slowest_preset or min_fps specified in settings.cfg. Exiting.")
+    sys.exit()
+
+# Presets the deadline and min_fps modes choose from, the slowest (best quality) first
+deadline_presets = preset_order[preset_order.index(fastest_preset):preset_order.index(slowest_preset) + 1][::-1]
+# The same range for NVENC jobs, limited to the names NVENC accepts
+nvenc_deadline_presets = list(dict.fromkeys(
+    next(nvenc_preset for nvenc_preset in closest_presets[preset] if nvenc_preset in nvenc_presets) for preset in deadline_presets
+))
+
+if deadline is not None and streaming:
+    print("Error: deadline needs the whole list of files and can't be used together with streaming. Exiting.")
+    sys.exit()
+
+if prediction_samples < 1 or prediction_sample_seconds < 1 or unprofitable_files not in ("skip", "copy"):
+    print("Error: Invalid value in the Size prediction section of settings.cfg. Exiting.")
+    sys.exit()
+
+if heartbeat_seconds < 1 or lease_seconds <= heartbeat_seconds:
+    print("Error: lease_seconds must be longer than heartbeat_seconds in settings.cfg. Exiting.")
+    sys.exit()
+
+if scratch_budget_gb <= 0 or prefetch_files < 0:
+    print("Error: Invalid value in the Staging section of settings.cfg. Exiting.")
+    sys.exit()
+
+if max_jobs < 1 or threads_per_job < 0 or max_cpu_jobs < 0 or max_nvenc_jobs < 0 or queue_size < 0:
+    print("Error: Invalid value in the Concurrency section of settings.cfg. Exiting.")
+    sys.exit()
+
+if scan_workers < 1:
+    print("Error: Invalid value in the Scan section of settings.cfg. Exiting.")
+    sys.exit()
+
+if not 0 < max_cpu_percent <= 100 or min_free_memory_mb < 0 or min_free_space_gb < 0 or resource_sample_seconds < 1:
+    print("Error: Invalid value in the Resources section of settings.cfg. Exiting.")
+    sys.exit()
+
+if verify_workers < 1 or verify_samples < 0 or verify_sample_seconds < 1 or verify_retries < 0:
+    print("Error: Invalid value in the Verification section of settings.cfg. Exiting.")
+    sys.exit()
+
+if hash_workers < 1:
+    print("Error: Invalid value in the Duplicates section of settings.cfg. Exiting.")
+    sys.exit()
+
+if detect_duplicates and streaming:
+    print("Error: detect_duplicates needs the whole list of files and can't be used together with streaming. Exiting.")
+    sys.exit()
+
+if segment_min_size_gb < 0 or segment_seconds < 1 or segment_workers < 1 or checkpoint_min_minutes < 0:
+    print("Error: Invalid value in the Segments section of settings.cfg. Exiting.")
+    sys.exit()
+
+# Slot limits per encoder type, 0 means only limited by max_jobs
+cpu_encoders = ["libx264", "libx265"]
+slot_limits = {
+    "cpu": min(max_cpu_jobs, max_jobs) if max_cpu_jobs > 0 else max_jobs,
+    "nvenc": min(max_nvenc_jobs, max_jobs) if max_nvenc_jobs > 0 else max_jobs,
+}
+
+# Number of files waiting for a worker, keeps memory flat however large the library is
+if queue_size == 0:
+    queue_size = max_jobs * 2
+
+# Threads handed to each CPU encoder job so parallel jobs don't oversubscribe the cores
+if threads_per_job > 0:
+    cpu_threads = threads_per_job
+elif max_jobs > 1:
+    cpu_threads = max(1, (os.cpu_count() or 1) // slot_limits["cpu"])
+else:
+    cpu_threads = 0  # Let ffmpeg decide, like a plain single job
+
 # Initialize counters
 success_counter = 0
 failed_counter = 0
 wrong_codec_counter = 0
+skipped_counter = 0  # Files that were predicted not to shrink enough
+other_node_counter = 0  # Files handled by other nodes of a shared queue
+duplicate_counter = 0  # Outputs linked or copied from the output of an identical file
 total_files = 0
 
 total_seconds = 0
 
+# Locks shared by the worker threads
+counter_lock = threading.Lock()  # Counters and totals
+print_lock = threading.Lock()    # Keeps multi-line console messages together
+stop_requested = threading.Event()
+discovery_finished = threading.Event()  # Set once every input file has been found
+batch_planned = threading.Event()  # Set once every input file has been probed for the ETA
+
+# Time spent in every phase of the per-file loop, and an optional cProfile of the whole run
+phase_timer = PhaseTimer(timing_report)
+profiler = ThreadProfiler(profile_run)
+profiler.start_main()
+
 def rgb_color(r, g, b):
     return f"\033[38;2;{r};{g};{b}m"
 
@@ -136,7 +363,7 @@ def format_seconds_dynamically(total_seconds):
         time_parts.append(f"{shades_of_yellow[2]}{minutes} minutes{Style.RESET_ALL}")
     if seconds > 0 or not time_parts:  # Include seconds if it's the only unit
         time_parts.append(f"{shades_of_yellow[3]}{seconds} seconds{Style.RESET_ALL}")
-    
+
     return ", ".join(time_parts)
 
 def format_file_size(file_path):
@@ -147,270 +374,1047 @@ def format_file_size(file_path):
             return f"{size_in_bytes:.2f} {unit}"
         size_in_bytes /= 1024
 
-# Load the list of completed files and their times
-completed_files = set()
-if os.path.exists(completed_files_path):
-    with open(completed_files_path, "r", encoding="utf-8") as cf:
-        for line in cf:
-            if line.strip():  # Ensure the line is not empty
-                try:
-                    # Split the line into time and file path
-                    seconds, file_path = line.split(" ", 1)
-                    if (seconds == "copied"):
-                        pass
-                    else: 
-                        total_seconds += int(seconds)  # Add the time to total_time
-                    completed_files.add((file_path.strip(), seconds))  # Add file path and the time it took to the set
-                except ValueError:
-                    print(f"Skipping malformed line in {completed_files_path}: {line.strip()}")
-                    sys.exit()
-    
-# Load the list of error files
-if os.path.exists(error_files_path):
-    with open(error_files_path, "r", encoding="utf-8") as cf:
-        error_files = set(line.strip() for line in cf if line.strip())
-else:
-    error_files = set()
-        
-# Load the list of wrong codec files
-if os.path.exists(wrong_codec_files_path):
-    with open(wrong_codec_files_path, "r", encoding="utf-8") as cf:
-        other_codec_files = set(line.strip() for line in cf if line.strip())
-else:
-    other_codec_files = set()
+def log(*lines, **kwargs):
+    """Print one or more lines without other workers writing in between."""
+    with print_lock:
+        for line in lines:
+            print(line, **kwargs)
 
-# Read the list of input files
-if (use_input_files_list):
-    with open(files_list_path, "r", encoding="utf-8") as f:
-        input_files = [line.strip() for line in f if line.strip() and not line.startswith("Total ")]
-        input_files = [f for f in input_files if f.lower().endswith(video_extensions)]  # Filter non-video files
-else:
-    # Recursively find all video files in the input_base directory
-    input_files = []
-    for path_and_name, _, files in os.walk(input_base_folder):
-        for file in files:
-            if file.lower().endswith(video_extensions):  # Use video_extensions for filtering
-                input_files.append(os.path.join(path_and_name, file))
-
-# Count total video files
-for input_file in input_files:
-    if input_file.lower().endswith(video_extensions):
-        total_files += 1
+def encoder_type(job_encoder):
+    return "cpu" if job_encoder in cpu_encoders else "nvenc"
 
-print()
+class EncoderSlots:
+    """Hands out encoders to the workers while respecting the slot limit of each encoder type."""
 
-# Process each file
-for input_file in input_files:
-    # Construct the output file path
+    def __init__(self, encoders, limits):
+        self.encoders = encoders
+        self.limits = limits
+        self.in_use = {"cpu": 0, "nvenc": 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                for job_encoder in self.encoders:
+                    slot_type = encoder_type(job_encoder)
+                    if self.in_use[slot_type] < self.limits[slot_type]:
+                        self.in_use[slot_type] += 1
+                        return job_encoder
+                self.condition.wait()
+
+    def release(self, job_encoder):
+        with self.condition:
+            self.in_use[encoder_type(job_encoder)] -= 1
+            self.condition.notify_all()
+
+encoder_slots = EncoderSlots(ffmpeg_encoders, slot_limits)
+
+# Lowers the number of encodes while the CPU or memory is maxed out, and holds back outputs that wouldn't fit
+resource_governor = ResourceGovernor(
+    max_jobs, output_base_folder, adaptive_jobs, max_cpu_percent, min_free_memory_mb * 1024 ** 2,
+    min_free_space_gb * 1024 ** 3, resource_sample_seconds, stop_requested,
+    lambda message: log(Fore.YELLOW + message + Style.RESET_ALL),
+)
+
+# Live fps, speed and size of the running ffmpeg processes. A single job gets one status line like ffmpeg's own
+# -stats, parallel jobs print a summary every console_interval seconds.
+progress_tracker = ProgressTracker(
+    events_path if write_events else None,
+    metrics_path if write_metrics else None,
+    metrics_interval,
+    console_interval if max_jobs > 1 else 0,
+    print_lock,
+)
+
+def use_segments(probe_info):
+    # Large files are split to encode them in parallel, long files to be able to resume them halfway
+    if segment_encoding and (probe_info.get("size") or 0) >= segment_min_size_gb * 1024 ** 3:
+        return True
+    return checkpoint_min_minutes > 0 and (probe_info.get("duration") or 0) >= checkpoint_min_minutes * 60
+
+def transcode_in_segments(input_file, source_file, output_file, job_encoder, job_preset):
+    # The segments share the thread budget of one job, x265 scales much better over several processes
+    workers = segment_workers if segment_encoding else 1
+    if cpu_threads == 0 and workers == 1:
+        segment_threads = 0  # Let ffmpeg decide, like a plain single job
+    else:
+        segment_threads = max(1, (cpu_threads or os.cpu_count() or 1) // workers)
+    work_dir = os.path.join(segments_folder, hashlib.sha1(input_file.encode("utf-8")).hexdigest()[:16])
+
+    # Finished segments are only reused for the same source file and the same encoding settings
+    source_stat = os.stat(input_file)
+    fingerprint = hashlib.sha1(
+        f"{source_stat.st_size}|{source_stat.st_mtime_ns}|{segment_seconds}|{' '.join(video_encoder_args(job_encoder, 0, job_preset))}".encode("utf-8")
+    ).hexdigest()
+    checkpoint = SegmentCheckpoint(job_state, input_file, fingerprint)
+
+    def run_segment(encode_cmd, segment_index):
+        segment_job = f"{input_file} [segment {segment_index}]"
+        progress_tracker.start(segment_job, input_file, job_encoder)
+        try:
+            run_ffmpeg(encode_cmd, progress_tracker, segment_job)
+        except subprocess.CalledProcessError:
+            progress_tracker.finish(segment_job, "error")
+            raise
+        progress_tracker.finish(segment_job, "segment")
+
+    return encode_in_segments(source_file, output_file, work_dir, video_encoder_args(job_encoder, segment_threads, job_preset),
+                              segment_seconds, workers, loglevel, stop_requested, checkpoint, run_segment)
+
+def size_prediction(input_file, source_file, job, probe_info, job_encoder, job_preset):
+    """Return the predicted output size and encode time of a file, or None if it can't be predicted.
+    A prediction stored in job_state.db is reused as long as the file and the video settings are the same."""
+    prediction_settings = " ".join(video_encoder_args(job_encoder, 0, job_preset))
+    if (job and job["predicted_size"] and job["prediction_settings"] == prediction_settings
+            and job["input_size"] == probe_info.get("size")):
+        return {"predicted_size": job["predicted_size"], "predicted_seconds": job["predicted_seconds"]}
+
+    work_dir = os.path.join(samples_folder, hashlib.sha1(input_file.encode("utf-8")).hexdigest()[:16])
     try:
-        relative_path = os.path.relpath(input_file, input_base_folder)
-    except ValueError as e:
-        print(Fore.RED + f"Error constructing relative path for {input_file}: {e}" + Style.RESET_ALL)
-        failed_counter += 1
-        if not any(input_file in error for error in error_files):
-            with open(error_files_path, "a", encoding="utf-8") as cf:
-                cf.write(f"Error constructing relative path: {input_file}\n")
-            error_files.add(f"Error constructing relative path: {input_file}")
-        continue
-    
+        with phase_timer.phase("size_prediction", input_file):
+            prediction = predict_output(source_file, probe_info, video_encoder_args(job_encoder, cpu_threads, job_preset), work_dir,
+                                        prediction_samples, prediction_sample_seconds, loglevel)
+    except (subprocess.CalledProcessError, OSError):
+        if stop_requested.is_set():
+            return None  # The samples were interrupted together with the script, the caller stops too
+        log(Fore.YELLOW + f"Could not encode samples of {input_file}, transcoding it without a size prediction" + Style.RESET_ALL)
+        return None
+    if prediction is None:
+        return None
+
+    with phase_timer.phase("state_write", input_file):
+        job_state.mark(input_file, "predicted", input_size=probe_info.get("size"),
+                       prediction_settings=prediction_settings, **prediction)
+    return prediction
+
+def skip_unprofitable_file(input_file, output_file, input_codec_name, savings):
+    # Skipped files are checked again (without new samples) on the next run, in case min_savings_percent changed
+    global skipped_counter, failed_counter
+    message = f"Predicted to shrink by only {savings:.0f}%" if savings >= 0 else f"Predicted to grow by {-savings:.0f}%"
+    if unprofitable_files == "copy":
+        # Keeps the original container, like copied wrong codec files
+        output_path = os.path.join(output_base_folder, os.path.relpath(input_file, input_base_folder))
+        log(Fore.MAGENTA + f"{message}, copying instead of transcoding:\n\n\t{Fore.CYAN}{input_file}" + Style.RESET_ALL)
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with phase_timer.phase("copy", input_file):
+                fast_copy(input_file, output_path, use_hardlinks)
+        except OSError as e:
+            log(Fore.RED + f"Error copying {input_file} to {output_path}: {e}" + Style.RESET_ALL)
+            with counter_lock:
+                failed_counter += 1
+            record_error(input_file, f"Error copying: {e}", output_path)
+            return
+        status = "copied"
+    else:
+        log(Fore.MAGENTA + f"{message}, skipping:\n\n\t{Fore.CYAN}{input_file}" + Style.RESET_ALL)
+        output_path = output_file
+        status = "skipped"
+    with counter_lock:
+        skipped_counter += 1
+    with phase_timer.phase("state_write", input_file):
+        job_state.mark(input_file, status, output_path=output_path, codec=input_codec_name, error=message)
+
+def leave_pending(input_file):
+    # Stopped before the encode started: nothing is recorded, the file is processed on the next run or by another node
+    if lease_queue is not None:
+        lease_queue.release(input_file)
+
+def record_error(input_file, message, output_file=None):
+    with phase_timer.phase("state_write", input_file):
+        job_state.mark(input_file, "error", output_path=output_file, error=message)
+
+def video_encoder_args(job_encoder, threads, job_preset=None):
+    # Ensure correct bit depth
+    if job_encoder in ["libx264", "h264_nvenc"]:
+        pixel_format = "yuv420p"  # Forces 8-bit
+    else:
+        pixel_format = "yuv420p10le"  # Forces 10-bit
+
+    # Limit the threads of CPU encoders when several jobs share the machine
+    thread_args = []
+    if threads > 0 and encoder_type(job_encoder) == "cpu":
+        thread_args = ["-threads", str(threads)]
+        if job_encoder == "libx265":
+            thread_args += ["-x265-params", f"pools={x265_pools(threads)}"]  # x265 ignores -threads for its own pools
+
+    return [
+        "-c:v", job_encoder, "-crf", crf_quality, "-preset", job_preset or speed_preset,
+        *thread_args,
+        "-pix_fmt", pixel_format,  # Explicitly enforce bit depth
+    ]
+
+def build_ffmpeg_cmd(input_file, output_file, job_encoder, job_preset=None):
+    # FFMPEG transcoding command
+    return [
+        "ffmpeg", "-y", "-i", input_file, "-map", "0",
+        *video_encoder_args(job_encoder, cpu_threads, job_preset),
+        "-c:a", "copy",  # Copy the audio without re-encoding
+        "-c:s", "copy",  # Copy subtitles
+        "-loglevel", loglevel,  # Show only errors
+        "-hide_banner",  # Suppress extra details
+        "-nostats",  # The progress is read from -progress and shown by the progress tracker
+        output_file
+    ]
+
+# Open the job state, importing the text files of older versions the first time
+job_state = JobStateStore(job_state_path)
+imported_lines = job_state.import_legacy_files(completed_files_path, error_files_path, wrong_codec_files_path)
+if imported_lines:
+    print(Fore.YELLOW + f"Imported {imported_lines} lines from the old completed/error/wrong codec files into {job_state_path}" + Style.RESET_ALL)
+total_seconds = job_state.total_seconds()
+
+# ffprobe results shared with find_files.py, unchanged files are not probed again
+probe_cache = ProbeCache(probe_cache_path)
+
+# Encode time predictions, learned from earlier runs and refined as files finish
+throughput_model = ThroughputModel.from_history(job_state.history())
+
+def predict_seconds(probe_info, job_encoder=None, job_preset=None):
+    return throughput_model.predict_preset(job_encoder or ffmpeg_encoder, job_preset or speed_preset, probe_info.get("height"),
+                                           probe_info.get("duration"), probe_info.get("size"))
+
+# Work left in the batch, encoder and preset are None until a job starts
+batch_eta = BatchEta(max_jobs, lambda encoder, preset, height, duration, size: throughput_model.predict_preset(
+    encoder or ffmpeg_encoder, preset or speed_preset, height, duration, size))
+
+def pick_preset(input_file, probe_info, job_encoder):
+    """Return the preset of a file: speed_preset, or in deadline and min_fps mode the slowest preset that fits.
+
+    The choice is made again for every file as it starts, with the encode times of the files that finished so far,
+    so the batch speeds up when it falls behind and slows down again when there is time to spare.
+    """
+    if deadline is None and min_fps <= 0:
+        return speed_preset
+
+    if deadline is not None:
+        time_left = deadline - time.time()
+
+        def fits(preset):
+            # Every file that hasn't started yet is assumed to use the same preset
+            seconds_left = batch_eta.seconds_left(job_encoder, preset)
+            return seconds_left is not None and seconds_left <= time_left
+    else:
+        frames = (probe_info.get("duration") or 0) * (probe_info.get("frame_rate") or 0)
+
+        def fits(preset):
+            predicted = predict_seconds(probe_info, job_encoder, preset)
+            return bool(predicted) and frames > 0 and frames / predicted >= min_fps
+
+    job_preset = choose_preset(deadline_presets if encoder_type(job_encoder) == "cpu" else nvenc_deadline_presets, fits)
+    if deadline is not None:
+        reason = f"to finish by {datetime.fromtimestamp(deadline):%Y-%m-%d %H:%M}"
+    else:
+        reason = f"to encode at {min_fps:g} fps or more"
+    if throughput_model.sample_count() == 0:
+        reason += " (no encode times known yet)"
+    log(Fore.YELLOW + f"Using preset {job_preset} {reason}" + Style.RESET_ALL)
+    return job_preset
+
+def build_output_path(input_file):
+    # Mirror the input folder structure in the output folder
+    relative_path = os.path.relpath(input_file, input_base_folder)
     output_file = os.path.join(output_base_folder, relative_path)
-    
-    bit_depth = "8bit" if ffmpeg_encoder in ["libx264", "h264_nvenc"] else "10bit"  
+
     path_and_name, original_extension = os.path.splitext(output_file)
-    
+
     if use_different_extension:
         output_file = f"{path_and_name}.{output_extension}"
+    return output_file
 
-    matching_tuple = None
+# Files are claimed through lease files, so nodes sharing the queue folder never work on the same file
+lease_queue = LeaseQueue(queue_folder, node_name, lease_seconds, heartbeat_seconds) if shared_queue else None
+leased_elsewhere = []  # Files another node was working on when this node got to them
+unfinished_outputs = set()  # Files whose output is still being moved or verified, they are finished by the move or the check
+duplicates_of = {}  # Transcoded file -> files with the same contents that get a copy of its output
+duplicate_outcomes = ("completed", "copied", "remuxed", "skipped", "error")  # Outcomes the duplicates take over
+run_started_at = time.time()  # Outcomes recorded before this are from earlier runs
 
-    # Iterate through the completed_files set
-    for completed in completed_files:
-        if output_file == completed[0]:  # Check if the file matches
-            matching_tuple = completed   # Save the matching tuple
-            break                        # Exit the loop once a match is found
+def finish_output(input_file):
+    # The output is in place (or won't be): free its reserved space and hand the file back to the shared queue
+    with counter_lock:
+        unfinished_outputs.discard(input_file)
+    resource_governor.release_space(input_file)
+    if lease_queue is not None and lease_queue.holds(input_file):
+        finish_lease(input_file)
+    with counter_lock:
+        has_duplicates = input_file in duplicates_of
+    if not has_duplicates:
+        return
+    # Only once the file has its outcome from this run. If it was left to another node or stopped, they stay until it is done.
+    job = job_state.get(input_file)
+    if job is None or job["status"] not in duplicate_outcomes or (job["finished_at"] or 0) < run_started_at:
+        return
+    with counter_lock:
+        duplicates = duplicates_of.pop(input_file, None)
+    if duplicates:
+        finish_duplicates(input_file, duplicates)
 
-    # Skip if the file is already marked as completed
-    if matching_tuple:
-        if (matching_tuple[1] != "copied"):
-            success_counter += 1
-            print(Fore.CYAN + f"{success_counter+wrong_codec_counter+failed_counter}. File already transcoded ({format_seconds_dynamically(int(matching_tuple[1]))}" + Fore.CYAN + f"): {output_file}" + Style.RESET_ALL, sep="")
-        else:
-            wrong_codec_counter += 1
-            print(Fore.CYAN + f"{success_counter+wrong_codec_counter+failed_counter}. File already copied: " + Fore.CYAN + f"{output_file}" + Style.RESET_ALL, sep="")
-        matching_tuple = None  # We are done using it, uninitializing it
-        continue
-    
-    print(f"\n\n--------------------------------")
-    print(f"{success_counter} files successfully transcoded")
-    print(f"{Fore.RED if failed_counter > 0 else Style.RESET_ALL}{failed_counter} files failed{Style.RESET_ALL}")
-    print(f"{Fore.MAGENTA if wrong_codec_counter > 0 else Style.RESET_ALL}{wrong_codec_counter} files not in {input_codec} {Style.RESET_ALL}", end="")
-    if ((copy_files_of_wrong_codec)):
-        print("(Copied)")
+def count_completed(input_file):
+    # The output is in place (and verified): learn from the encode and count it
+    global success_counter, total_seconds
+    job = job_state.get(input_file)
+    throughput_model.add_sample(job["encoder"], job["preset"], job["height"], job["duration"], job["input_size"],
+                                job["finished_at"] - job["started_at"])
+    throughput_model.add_output_size(job["encoder"], job["input_size"], job["output_size"])
+    with counter_lock:
+        success_counter += 1
+        total_seconds += job["seconds"]
+    finish_output(input_file)
+
+    log(
+        Fore.GREEN + f"\n{job['output_path']}\n"
+        + Fore.CYAN + "Successfully finished transcoding! \n"
+        + Fore.YELLOW + f"File took {format_seconds_dynamically(job['seconds'])}{Fore.YELLOW} to transcode. "
+        + Style.RESET_ALL
+    )
+
+# Outputs are checked by their own workers, so the encodes go on while the finished files are verified
+verifier = ThreadPoolExecutor(max_workers=verify_workers) if verify_outputs else None
+verifications = set()  # Verifications that haven't finished yet
+verify_failed = []  # Files whose output failed the verification, encoded again
+verify_attempts = {}  # File -> number of outputs that failed the verification in this run
+
+def submit_verification(input_file, source_info):
+    future = verifier.submit(verify_job, input_file, source_info)
+    with counter_lock:
+        verifications.add(future)
+    def verification_finished(future):
+        with counter_lock:
+            verifications.discard(future)
+    future.add_done_callback(verification_finished)
+
+def verify_job(input_file, source_info, queue_retry=True):
+    """Check the output of a file. Returns True if it failed and the file should be transcoded again,
+    which is queued unless queue_retry is False, then the caller transcodes it right away."""
+    global failed_counter
+    job = job_state.get(input_file)
+    try:
+        with phase_timer.phase("verify", input_file):
+            problem = verify_output(job["output_path"], source_info, verify_samples, verify_sample_seconds)
+    except Exception as e:
+        problem = f"Unexpected error: {e}"
+    if problem is not None and stop_requested.is_set():
+        return False  # ffprobe or the decode was interrupted, the file stays "verifying" and is checked on the next run
+    with phase_timer.phase("state_write", input_file):
+        job_state.mark(input_file, "completed" if problem is None else "error", verified_at=time.time(),
+                       verification=problem or "passed", error=f"Output failed the verification: {problem}" if problem else None)
+    if problem is None:
+        count_completed(input_file)
+        return False
+
+    # A broken output must not be taken for a finished one, not even by a later run
+    try:
+        os.remove(job["output_path"])
+    except OSError:
+        pass
+    with counter_lock:
+        verify_attempts[input_file] = verify_attempts.get(input_file, 0) + 1
+        retry = verify_attempts[input_file] <= verify_retries and not stop_requested.is_set()
+        if not retry:
+            failed_counter += 1
+        elif queue_retry:
+            verify_failed.append(input_file)
+    log(Fore.RED + f"Output of {input_file} failed the verification: {problem}"
+        + (". Transcoding it again." if retry else ". Skipping.") + Style.RESET_ALL)
+    if retry:
+        # Keeps the lease, and the duplicates wait for the next output
+        with counter_lock:
+            unfinished_outputs.discard(input_file)
+        resource_governor.release_space(input_file)
     else:
-        print("")
-    print(f"{total_files-success_counter-failed_counter-wrong_codec_counter} files left to transcode")
-    print(f"{total_files} files total")
-    print(f"--------------------------------\n\n")
+        finish_output(input_file)
+    return retry
 
-    # Get the codec of the file
+def finish_duplicates(input_file, duplicates):
+    # The files with the same contents get the same outcome as the file that was transcoded
+    global duplicate_counter, skipped_counter, failed_counter
+    job = job_state.get(input_file)
+    for duplicate in duplicates:
+        if job["status"] == "skipped":
+            with counter_lock:
+                skipped_counter += 1
+            job_state.mark(duplicate, "skipped", output_path=build_output_path(duplicate), codec=job["codec"], error=job["error"],
+                           input_size=job["input_size"], predicted_size=job["predicted_size"],
+                           predicted_seconds=job["predicted_seconds"], prediction_settings=job["prediction_settings"])
+            continue
+        if job["status"] == "error":
+            with counter_lock:
+                failed_counter += 1
+            record_error(duplicate, f"Same contents as {input_file}, which failed: {job['error']}")
+            continue
+
+        # Same folder structure and extension as the output it is made from
+        output_path = os.path.splitext(build_output_path(duplicate))[0] + os.path.splitext(job["output_path"])[1]
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with phase_timer.phase("duplicate", duplicate):
+                method = fast_copy(job["output_path"], output_path, link_duplicates)
+        except OSError as e:
+            log(Fore.RED + f"Error copying the output of {input_file} to {output_path}: {e}" + Style.RESET_ALL)
+            with counter_lock:
+                failed_counter += 1
+            record_error(duplicate, f"Error copying the output of the identical file {input_file}: {e}", output_path)
+            continue
+        with counter_lock:
+            duplicate_counter += 1
+        with phase_timer.phase("state_write", duplicate):
+            job_state.mark(duplicate, "duplicate", output_path=output_path, duplicate_of=input_file, error=None, seconds=0,
+                           finished_at=time.time(), input_size=job["input_size"], output_size=job["output_size"])
+        log(Fore.CYAN + f"Same contents as {input_file}, {'linked' if method == 'hardlink' else 'copied'} its output to:\n\n\t{output_path}" + Style.RESET_ALL)
+
+def finish_lease(input_file):
+    # Publish the outcome to the other nodes, or give the file back if it wasn't finished
+    job = job_state.get(input_file)
+    if job is None or job["status"] in ("transcoding", "predicted"):
+        lease_queue.release(input_file)
+    else:
+        try:
+            lease_queue.finish(input_file, job["status"], seconds=job["seconds"], output_path=job["output_path"], error=job["error"])
+        except OSError as e:
+            # The outcome is in job_state.db, but other nodes may encode the file again once its lease expires
+            log(Fore.RED + f"Error writing the result of {input_file} to the queue folder: {e}" + Style.RESET_ALL)
+
+# Local copies of the next inputs, and outputs that are moved to the output folder in the background
+staging = None
+if staging_enabled:
+    staging = ScratchStaging(scratch_folder, int(scratch_budget_gb * 1024 ** 3), prefetch_files,
+                             lambda input_file: bool(plan_job(input_file)))
+
+def discover_input_files():
+    """Yield the input files one by one, so encoding can start before the whole tree has been walked."""
+    if (use_input_files_list):
+        with open(files_list_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("Total ") and line.lower().endswith(video_extensions):  # Filter non-video files
+                    yield line
+    else:
+        # Recursively find all video files in the input_base directory
+        for path_and_name, _, files in os.walk(input_base_folder):
+            for file in files:
+                if file.lower().endswith(video_extensions):  # Use video_extensions for filtering
+                    yield os.path.join(path_and_name, file)
+
+
+def process_file(input_file):
+    global success_counter, failed_counter, wrong_codec_counter, skipped_counter, other_node_counter, duplicate_counter, total_seconds
+
+    if stop_requested.is_set():
+        return
+
+    # Construct the output file path
     try:
-        ffprobe_cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "v:0",
-            "-show_entries", "stream=codec_name,profile,pix_fmt", "-of", "default=noprint_wrappers=1:nokey=1", input_file
+        with phase_timer.phase("output_path", input_file):
+            output_file = build_output_path(input_file)
+    except ValueError as e:
+        log(Fore.RED + f"Error constructing relative path for {input_file}: {e}" + Style.RESET_ALL)
+        with counter_lock:
+            failed_counter += 1
+        record_error(input_file, f"Error constructing relative path: {e}")
+        return
+
+    # Skip if the file is already marked as completed
+    with phase_timer.phase("resume_lookup", input_file):
+        job = job_state.find(input_file, output_file)
+    if job and job["status"] in done_statuses:
+        with counter_lock:
+            if (job["status"] == "completed"):
+                success_counter += 1
+                message = Fore.CYAN + f"{success_counter+wrong_codec_counter+skipped_counter+failed_counter}. File already transcoded ({format_seconds_dynamically(int(job['seconds'] or 0))}" + Fore.CYAN + f"): {output_file}" + Style.RESET_ALL
+            elif job["status"] == "duplicate":
+                duplicate_counter += 1
+                message = Fore.CYAN + f"File already copied from the output of the identical {job['duplicate_of']}: " + Fore.CYAN + f"{job['output_path']}" + Style.RESET_ALL
+            else:
+                if job["predicted_size"]:
+                    skipped_counter += 1  # Copied because it would not have shrunk
+                else:
+                    wrong_codec_counter += 1
+                message = Fore.CYAN + f"{success_counter+wrong_codec_counter+skipped_counter+failed_counter}. File already copied: " + Fore.CYAN + f"{output_file}" + Style.RESET_ALL
+        log(message)
+        if lease_queue is not None and lease_queue.result(input_file) is None:
+            # Done before this node joined the shared queue, let the other nodes know
+            lease_queue.write_result(input_file, job["status"], seconds=job["seconds"], output_path=job["output_path"])
+        return
+
+    # Only the node holding the lease on a file processes it
+    if lease_queue is not None:
+        claimed, result = lease_queue.claim(input_file)
+        if not claimed:
+            if result is not None:
+                with counter_lock:
+                    other_node_counter += 1
+                log(Fore.CYAN + f"File already handled by {result['node']} ({result['status']}): {input_file}" + Style.RESET_ALL)
+            else:
+                with counter_lock:
+                    leased_elsewhere.append(input_file)
+                log(Fore.CYAN + f"File is being processed by another node: {input_file}" + Style.RESET_ALL)
+            return
+
+    time_left_lines = eta_lines()  # Outside the counter lock, the other workers shouldn't wait for the prediction
+    with counter_lock:
+        status_lines = [
+            f"\n\n--------------------------------",
+            f"{success_counter} files successfully transcoded",
+            f"{Fore.RED if failed_counter > 0 else Style.RESET_ALL}{failed_counter} files failed{Style.RESET_ALL}",
+            f"{Fore.MAGENTA if wrong_codec_counter > 0 else Style.RESET_ALL}{wrong_codec_counter} files not in {input_codec} {Style.RESET_ALL}"
+            + ("(Copied)" if copy_files_of_wrong_codec else ""),
+            *([f"{skipped_counter} files predicted not to shrink ({'copied' if unprofitable_files == 'copy' else 'skipped'})"] if predict_size else []),
+            *([f"{other_node_counter} files handled by other nodes"] if lease_queue is not None else []),
+            *([f"{duplicate_counter} duplicates copied from the output of an identical file"] if detect_duplicates else []),
+            *resource_lines(),
+            *files_left_lines(),
+            *time_left_lines,
+            f"--------------------------------\n\n",
         ]
-        output = subprocess.check_output(ffprobe_cmd, text=True).strip().split("\n")
+    with phase_timer.phase("console", input_file):
+        log(*status_lines)
+
+    # Get the codec of the file
+    try:
+        with phase_timer.phase("probe", input_file):
+            probe_info = probe_cache.probe(input_file)
 
         # Assign correct values
-        input_codec_name = output[0].strip().replace(".", "").replace("-", "").lower() if len(output) > 0 else "unknown"
-        input_profile = output[1] if len(output) > 1 else "Unknown"
-        input_pixel_format = output[2] if len(output) > 2 else "Unknown"
-
-        print(f"Detected Codec: {input_codec_name}, Profile: {input_profile}, Pixel Format: {input_pixel_format}")
-    except subprocess.CalledProcessError:
-        print(Fore.RED + f"Error reading codec for {input_file}. Skipping." + Style.RESET_ALL)
-        input_codec_name, input_profile, input_pixel_format = "Unknown", "Unknown", "Unknown"
-        failed_counter += 1
-        
-        if not any(input_file in error for error in error_files):
-            with open(error_files_path, "a", encoding="utf-8") as cf:
-                cf.write(f"Error reading codec: {input_file}\n")
-            error_files.add(f"Error reading codec: {input_file}")
-        continue
+        input_codec_name = probe_info["codec_name"].strip().replace(".", "").replace("-", "").lower()
+        input_profile = probe_info["profile"]
+        input_pixel_format = probe_info["pix_fmt"]
+
+        log(f"Detected Codec: {input_codec_name}, Profile: {input_profile}, Pixel Format: {input_pixel_format}")
+    except ProbeError:
+        log(Fore.RED + f"Error reading codec for {input_file}. Skipping." + Style.RESET_ALL)
+        with counter_lock:
+            failed_counter += 1
+        record_error(input_file, "Error reading codec")
+        return
+
+    # Stopped before the output of the previous run was checked, only the check is left
+    if verify_outputs and job and job["status"] == "verifying" and os.path.exists(job["output_path"]):
+        log(Fore.YELLOW + f"Verifying the output of the previous run: {job['output_path']}" + Style.RESET_ALL)
+        if not verify_job(input_file, probe_info, queue_retry=False):
+            return
+        # Transcoded again by this job, which keeps the lease and the duplicates until the new output is done
+        job = job_state.get(input_file)
 
     # If file is the right codec, start transcoding process
     if input_codec_name.lower() == ffmpeg_input_codec.lower() or skip_codec_checking:
-        
+
         # Ensure the output directory exists
         output_dir = os.path.dirname(output_file)
         if not os.path.exists(output_dir):
             try:
-                os.makedirs(output_dir, exist_ok=True)
+                with phase_timer.phase("makedirs", input_file):
+                    os.makedirs(output_dir, exist_ok=True)
             except OSError as e:
-                print(Fore.RED + f"Failed to create directory {output_dir}: {e}" + Style.RESET_ALL)
-                failed_counter += 1
-                
-                if not any(output_dir in error for error in error_files):
-                    with open(error_files_path, "a", encoding="utf-8") as cf:
-                        cf.write(f"Error creating directory: {output_dir}\n")
-                    error_files.add(f"Error creating directory: {output_dir}")
-                continue
-            print(Fore.YELLOW + f"Created directory: {output_dir}" + Style.RESET_ALL)
-        
-        # Printout of what file is going to be transcoded
-        print(
-            Fore.GREEN + f"Starting transcoding process of a "
-            + f"{Fore.RED}{format_file_size(input_file)}"
-            + f"{Fore.GREEN} file: "
-            + f"\n\n\t{Fore.CYAN}{input_file}"
-            + f"{Fore.GREEN}\n" + Style.RESET_ALL
-        )
-        
-        
-        # Ensure correct bit depth
-        if ffmpeg_encoder in ["libx264", "h264_nvenc"]:
-            pixel_format = "yuv420p"  # Forces 8-bit
-        elif ffmpeg_encoder in ["libx265", "h265_nvenc"]:
-            pixel_format = "yuv420p10le"  # Forces 10-bit
-        else:
-            print("Error: Unknown encoder. Skipping.")
-            continue
+                log(Fore.RED + f"Failed to create directory {output_dir}: {e}" + Style.RESET_ALL)
+                with counter_lock:
+                    failed_counter += 1
+                record_error(input_file, f"Error creating directory {output_dir}: {e}", output_file)
+                return
+            log(Fore.YELLOW + f"Created directory: {output_dir}" + Style.RESET_ALL)
 
+        # Read the input from the scratch folder if it was prefetched there, waits for a copy in progress
+        source_file = input_file
+        if staging is not None:
+            with phase_timer.phase("stage_wait", input_file):
+                source_file = staging.acquire(input_file)
 
+        # Wait for a free encoder slot
+        with phase_timer.phase("slot_wait", input_file):
+            job_encoder = encoder_slots.acquire()
+        try:
+            with phase_timer.phase("resource_wait", input_file):
+                if stop_requested.is_set() or not resource_governor.acquire(input_file):
+                    leave_pending(input_file)
+                    return
 
-        # FFMPEG transcoding command
-        ffmpeg_cmd = [
-            "ffmpeg", "-y", "-i", input_file, "-map", "0",  
-            "-c:v", ffmpeg_encoder, "-crf", crf_quality, "-preset", speed_preset,
-            "-pix_fmt", pixel_format,  # Explicitly enforce bit depth
-            "-c:a", "copy",  # Copy the audio without re-encoding
-            "-c:s", "copy",  # Copy subtitles
-            "-loglevel", loglevel,  # Show only errors
-            "-hide_banner",  # Suppress extra details
-            "-stats",  # Show encoding stats
-            output_file
-        ]
+            job_preset = pick_preset(input_file, probe_info, job_encoder)
 
+            # Encode a few samples first, files that would barely shrink are not worth hours of encoding
+            output_estimate = None
+            if predict_size:
+                prediction = size_prediction(input_file, source_file, job, probe_info, job_encoder, job_preset)
+                if prediction is not None:
+                    output_estimate = prediction["predicted_size"]
+                    savings = predicted_savings(probe_info.get("size"), prediction["predicted_size"])
+                    log(Fore.YELLOW + f"Predicted output size: {prediction['predicted_size'] / 1024 ** 3:.2f} GB ({abs(savings):.0f}% {'smaller' if savings >= 0 else 'larger'}), "
+                        + f"about {format_seconds_dynamically(int(prediction['predicted_seconds']))}{Fore.YELLOW} to transcode" + Style.RESET_ALL)
+                    if savings < min_savings_percent:
+                        skip_unprofitable_file(input_file, output_file, input_codec_name, savings)
+                        return
+                if stop_requested.is_set():
+                    leave_pending(input_file)
+                    return
 
-    
-        # Transcode!
-        try:
-            # Start a timer
-            start_time = time.time()
-            
-            # Transcoding command
-            subprocess.run(ffmpeg_cmd, check=True)
-            
-            # Stop timer
-            transcoding_time = int(time.time() - start_time)
-            
-            # Mark as completed
-            with open(completed_files_path, "a", encoding="utf-8") as cf:
-                cf.write(f"{transcoding_time} {output_file} \n")
-            
-            # Increment the counter
-            success_counter += 1
-            total_seconds += transcoding_time
-            
-            print(
-                Fore.GREEN + f"\n{output_file}\n"
-                + Fore.CYAN + "Successfully finished transcoding! \n"
-                + Fore.YELLOW + f"File took {format_seconds_dynamically(transcoding_time)}{Fore.YELLOW} to transcode. "
-                + Style.RESET_ALL
+            # Wait for room on the output drive instead of running it full halfway through the encode
+            if output_estimate is None:
+                output_estimate = throughput_model.predict_output_size(job_encoder, probe_info.get("size") or 0)
+            with phase_timer.phase("space_wait", input_file):
+                try:
+                    if not resource_governor.reserve(input_file, output_estimate):
+                        leave_pending(input_file)
+                        return
+                except NotEnoughSpaceError as e:
+                    log(Fore.RED + f"{e}. Skipping {input_file}" + Style.RESET_ALL)
+                    with counter_lock:
+                        failed_counter += 1
+                    record_error(input_file, str(e), output_file)
+                    return
+
+            # Stopped while waiting for the prediction or the space, the encode isn't started anymore
+            if stop_requested.is_set():
+                leave_pending(input_file)
+                return
+
+            batch_eta.start(input_file, probe_info, job_encoder, job_preset)
+
+            # Printout of what file is going to be transcoded
+            log(
+                Fore.GREEN + f"Starting transcoding process of a "
+                + f"{Fore.RED}{format_file_size(input_file)}"
+                + f"{Fore.GREEN} file"
+                + (f" with {job_encoder}" if len(ffmpeg_encoders) > 1 else "")
+                + ": "
+                + f"\n\n\t{Fore.CYAN}{input_file}"
+                + f"{Fore.GREEN}\n" + Style.RESET_ALL
             )
-              
-        # Transcoding failed...  
-        except subprocess.CalledProcessError:
-            print(Fore.RED + f"Error transcoding {input_file}. Skipping." + Style.RESET_ALL)
-            failed_counter += 1
-            
-            if not any(input_file in error for error in error_files):
-                with open(error_files_path, "a", encoding="utf-8") as cf:
-                    cf.write(f"Error while transcoding: {input_file}\n")
-                error_files.add(f"Error while transcoding: {input_file}")
-            continue
+
+            # The output goes to the scratch folder too if there is room, and is moved after the encode
+            encode_output = output_file
+            if staging is not None:
+                encode_output = staging.output_path(input_file, output_file, output_estimate)
+
+            # Transcode!
+            try:
+                # Start a timer
+                start_time = time.time()
+                with phase_timer.phase("state_write", input_file):
+                    job_state.mark(input_file, "transcoding", output_path=output_file, codec=input_codec_name, started_at=start_time)
+
+                # Transcoding command, written to a temporary name so a partial file is never taken for a finished one
+                if use_segments(probe_info):
+                    with phase_timer.phase("encode", input_file):
+                        segment_count, reused_segments = transcode_in_segments(input_file, source_file, partial_path(encode_output),
+                                                                               job_encoder, job_preset)
+                    log(Fore.YELLOW + f"Encoded {input_file} as {segment_count} segments"
+                        + (f", {reused_segments} of them finished in an earlier run" if reused_segments else "") + Style.RESET_ALL)
+                else:
+                    progress_tracker.start(input_file, input_file, job_encoder, probe_info.get("duration"))
+                    try:
+                        with phase_timer.phase("encode", input_file):
+                            run_ffmpeg(build_ffmpeg_cmd(source_file, partial_path(encode_output), job_encoder, job_preset), progress_tracker, input_file)
+                    except subprocess.CalledProcessError:
+                        progress_tracker.finish(input_file, "error")
+                        raise
+                    progress_tracker.finish(input_file, "completed")
+                with phase_timer.phase("rename", input_file):
+                    os.replace(partial_path(encode_output), encode_output)
+
+            # Transcoding failed...
+            except (subprocess.CalledProcessError, OSError):
+                if stop_requested.is_set():
+                    return  # ffmpeg was interrupted together with the script, not a broken file
+                log(Fore.RED + f"Error transcoding {input_file}. Skipping." + Style.RESET_ALL)
+                if os.path.exists(partial_path(encode_output)):
+                    os.remove(partial_path(encode_output))
+                if encode_output != output_file:
+                    staging.discard_output(encode_output)
+                with counter_lock:
+                    failed_counter += 1
+                record_error(input_file, "Error while transcoding", output_file)
+                return
+
+            # Stop timer. The bookkeeping below is outside the try, a failure there is no transcoding error.
+            finished_time = time.time()
+            transcoding_time = int(finished_time - start_time)
+
+            def record_completed():
+                # Mark as completed and increment the counter once the output is in the output folder, or have it verified first
+                with phase_timer.phase("state_write", input_file):
+                    job_state.mark(input_file, "verifying" if verify_outputs else "completed", output_path=output_file,
+                                   seconds=transcoding_time, error=None, finished_at=finished_time, input_size=probe_info.get("size"),
+                                   duration=probe_info.get("duration"), height=probe_info.get("height"),
+                                   encoder=job_encoder, preset=job_preset, crf=crf_quality_int,
+                                   output_size=os.path.getsize(output_file))
+                if verify_outputs:
+                    submit_verification(input_file, probe_info)
+                else:
+                    count_completed(input_file)
+
+            def record_move_failed(error):
+                global failed_counter
+                log(Fore.RED + f"Error moving {encode_output} to {output_file}: {error}" + Style.RESET_ALL)
+                with counter_lock:
+                    failed_counter += 1
+                record_error(input_file, f"Error moving the output from the scratch folder: {error}", output_file)
+                finish_output(input_file)
+
+            if encode_output != output_file or verify_outputs:
+                with counter_lock:
+                    unfinished_outputs.add(input_file)
+            if encode_output != output_file:
+                staging.publish(encode_output, output_file, record_completed, record_move_failed)
+            else:
+                record_completed()
+        finally:
+            resource_governor.finish_encode(input_file)
+            encoder_slots.release(job_encoder)
     else:
-        print(Fore.MAGENTA + f"File is not {input_codec}:\n\n\t{Fore.CYAN}{input_file}" + Style.RESET_ALL)
-        wrong_codec_counter += 1
-        
+        log(Fore.MAGENTA + f"File is not {input_codec}:\n\n\t{Fore.CYAN}{input_file}" + Style.RESET_ALL)
+        with counter_lock:
+            wrong_codec_counter += 1
+
         if (copy_files_of_wrong_codec):
-            
-            print(f"{Fore.YELLOW}\nCopying... {Style.RESET_ALL}")
-            
+
             # Construct the output path
             relative_path = os.path.relpath(input_file, input_base_folder)  # Get relative path from input_base
             output_path = os.path.join(output_base_folder, relative_path)
 
+            # Only the container changes, the streams are copied as they are
+            remux = remux_wrong_codec_files and use_different_extension and output_path != output_file
+            if remux:
+                output_path = output_file
+
             # Ensure the output directory exists
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
             try:
-                # Check if the file exists
-                if os.path.exists(output_path):
-                    os.remove(output_path)  # Remove the file if it exists
-                
-                # Copy the file
-                shutil.copy(input_file, output_path)
-                
+                if remux:
+                    log(f"{Fore.YELLOW}\nRemuxing to .{output_extension}... {Style.RESET_ALL}")
+                    remux_cmd = [
+                        "ffmpeg", "-y", "-i", input_file, "-map", "0", "-c", "copy",
+                        "-loglevel", loglevel, "-hide_banner", "-nostats", partial_path(output_path)
+                    ]
+                    progress_tracker.start(input_file, input_file, "copy", probe_info.get("duration"))
+                    try:
+                        with phase_timer.phase("remux", input_file):
+                            run_ffmpeg(remux_cmd, progress_tracker, input_file)
+                    except Exception:
+                        progress_tracker.finish(input_file, "error")
+                        raise
+                    progress_tracker.finish(input_file, "remuxed")
+                    os.replace(partial_path(output_path), output_path)
+                    status, method = "remuxed", "remux"
+                else:
+                    log(f"{Fore.YELLOW}\nCopying... {Style.RESET_ALL}")
+                    with phase_timer.phase("copy", input_file):
+                        status, method = "copied", fast_copy(input_file, output_path, use_hardlinks)
+
             except PermissionError as e:
-                print(f"Permission denied while copying {input_file} to {output_path}. Error: {e}")
+                log(f"Permission denied while copying {input_file} to {output_path}. Error: {e}")
+                if remux and os.path.exists(partial_path(output_path)):
+                    os.remove(partial_path(output_path))
+                record_error(input_file, f"Error copying: {e}", output_path)
+                return
 
             except Exception as e:
-                print(f"An unexpected error occurred while copying {input_file} to {output_path}. Error: {e}")
-                
-            
+                log(f"An unexpected error occurred while copying {input_file} to {output_path}. Error: {e}")
+                if remux and os.path.exists(partial_path(output_path)):
+                    os.remove(partial_path(output_path))
+                record_error(input_file, f"Error copying: {e}", output_path)
+                return
+
+            if method == "skipped":
+                log(f"{Fore.YELLOW}Already copied earlier: {output_path}{Style.RESET_ALL}")
+            elif verbose_information:
+                log(f"Copied with {method}: {output_path}")
+
             # Mark as completed
-            with open(completed_files_path, "a", encoding="utf-8") as cf:
-                cf.write(f"copied {output_path}\n")
-        
-        if not any(input_file in error for error in other_codec_files):
-            with open(wrong_codec_files_path, "a", encoding="utf-8") as cf:
-                cf.write(f"File is {input_codec_name}, not {ffmpeg_input_codec}: " + output_file + " \n")
-            other_codec_files.add(f"File is {input_codec_name}, not {ffmpeg_input_codec}: {output_file}")
+            with phase_timer.phase("state_write", input_file):
+                job_state.mark(input_file, status, output_path=output_path, codec=input_codec_name,
+                               error=f"File is {input_codec_name}, not {ffmpeg_input_codec}")
+        else:
+            with phase_timer.phase("state_write", input_file):
+                job_state.mark(input_file, "wrong_codec", output_path=output_file, codec=input_codec_name,
+                               error=f"File is {input_codec_name}, not {ffmpeg_input_codec}")
+
+def resource_lines():
+    if not adaptive_jobs:
+        return []
+    limit, cpu_percent, memory = resource_governor.status()
+    return [f"{limit} of {max_jobs} jobs allowed at once"
+            + (f" (CPU {cpu_percent:.0f}%" if cpu_percent is not None else " (CPU unknown")
+            + (f", {memory / 1024 ** 3:.1f} GB memory available)" if memory is not None else ")")]
+
+def files_left_lines():
+    files_left = total_files - success_counter - failed_counter - wrong_codec_counter - skipped_counter - other_node_counter - duplicate_counter
+    if discovery_finished.is_set():
+        return [f"{files_left} files left to transcode", f"{total_files} files total"]
+    # While streaming the totals grow as more files are found
+    return [f"At least {files_left} files left to transcode (still looking for files)", f"{total_files} files found so far"]
+
+def eta_lines():
+    deadline_lines = [f"Deadline: {datetime.fromtimestamp(deadline):%Y-%m-%d %H:%M}"] if deadline is not None else []
+    if streaming:
+        return deadline_lines  # Files that haven't been found yet can't be predicted
+    if not batch_planned.is_set():
+        return ["Estimated time left: unknown until every file has been probed"] + deadline_lines
+    seconds_left = batch_eta.seconds_left()
+    if seconds_left is None:
+        return ["Estimated time left: unknown until the first file has finished"] + deadline_lines
+    return [f"Estimated time left: {format_seconds_dynamically(int(seconds_left))}{Style.RESET_ALL}"] + deadline_lines
+
+def run_job(input_file, submitted_at):
+    # Keep the pool alive if a single file blows up in an unexpected way
+    global failed_counter
+    phase_timer.add("queue_wait", time.perf_counter() - submitted_at)
+    with counter_lock:
+        started_jobs.add(input_file)  # The background planner leaves it out of the ETA from now on
+    try:
+        with phase_timer.phase("job"):
+            profiler.profile_call(process_file, input_file)
+    except Exception as e:
+        log(Fore.RED + f"Unexpected error while processing {input_file}: {e}" + Style.RESET_ALL)
+        with counter_lock:
+            failed_counter += 1
+        record_error(input_file, f"Unexpected error: {e}")
+    finally:
+        batch_eta.finish(input_file)
+        if staging is not None:
+            staging.release(input_file)
+        with counter_lock:
+            unfinished = input_file in unfinished_outputs
+        if not unfinished:
+            finish_output(input_file)
+
+def plan_job(input_file):
+    """Return the probe information of a file that still has to be processed, None if it is already done."""
+    try:
+        job = job_state.find(input_file, build_output_path(input_file))
+    except ValueError:
+        return {}
+    if job and job["status"] in done_statuses:
+        return None
+    if lease_queue is not None and lease_queue.result(input_file) is not None:
+        return None  # Handled by another node
+    try:
+        probe_info = probe_cache.probe(input_file)
+    except ProbeError:
+        return {}  # Fails right away once it is processed
+    if probe_info["codec_name"].replace(".", "").replace("-", "").lower() != ffmpeg_input_codec and not skip_codec_checking:
+        return {}  # Wrong codec, only copied or skipped
+    return probe_info
+
+def plan_jobs(input_files):
+    print(f"Planning {len(input_files)} files...")
+    with ThreadPoolExecutor(max_workers=scan_workers) as planner:
+        planned = list(planner.map(plan_job, input_files))
+
+    # Files that are already done go first, they are only counted
+    done_files = [input_file for input_file, probe_info in zip(input_files, planned) if probe_info is None]
+
+    # Of identical files only the first is transcoded, the others get a copy of its output when it is done
+    duplicates = set()
+    if detect_duplicates:
+        candidates = [input_file for input_file, probe_info in zip(input_files, planned) if probe_info]
+        print(f"Looking for duplicates among {len(candidates)} files...")
+        with phase_timer.phase("find_duplicates"):
+            for group in find_duplicates(candidates, probe_cache, hash_workers):
+                duplicates_of[group[0]] = group[1:]
+                duplicates.update(group[1:])
+        if duplicates:
+            print(Fore.YELLOW + f"Found {len(duplicates)} duplicates of {len(duplicates_of)} files, they are transcoded once" + Style.RESET_ALL)
+
+    pending_jobs = []
+    for input_file, probe_info in zip(input_files, planned):
+        if probe_info is None or input_file in duplicates:
+            continue
+        batch_eta.add(input_file, probe_info)
+        predicted = predict_seconds(probe_info) if probe_info else 0
+        if predicted is None:
+            predicted = probe_info.get("size") or 0  # No history yet, the size still gives the right order
+        pending_jobs.append((input_file, predicted))
+    return done_files + [input_file for input_file, _ in order_jobs(pending_jobs, job_order)]
+
+started_jobs = set()  # Files a job has started on, the background planner doesn't add them to the ETA
+planner = None
+
+def plan_in_background(input_files):
+    # The files are already being encoded in the order they were found, the probes are only needed for the ETA
+    futures = [(input_file, planner.submit(plan_job, input_file)) for input_file in input_files]
+    for input_file, future in futures:
+        try:
+            probe_info = future.result()
+        except CancelledError:
+            return  # Stopped
+        if probe_info is None:
+            continue
+        with counter_lock:
+            if input_file not in started_jobs:
+                batch_eta.add(input_file, probe_info)
+    batch_planned.set()
+
+# Read the list of input files. In streaming mode they are found while the first files are already encoding.
+if streaming:
+    input_files = discover_input_files()
+elif job_order == "list" and deadline is None and not detect_duplicates:
+    # Nothing has to be known about the files before the first one starts, they are probed while it encodes
+    with phase_timer.phase("discovery"):
+        input_files = list(discover_input_files())
+    total_files = len(input_files)
+    discovery_finished.set()
+    print(f"Planning {len(input_files)} files while the first ones are encoding...")
+    planner = ThreadPoolExecutor(max_workers=scan_workers)
+    threading.Thread(target=plan_in_background, args=(input_files,), daemon=True).start()
+else:
+    with phase_timer.phase("discovery"):
+        input_files = plan_jobs(list(discover_input_files()))
+    total_files = len(input_files) + sum(len(duplicates) for duplicates in duplicates_of.values())
+    discovery_finished.set()
+    batch_planned.set()
+
+print()
+
+if max_jobs > 1:
+    print(Fore.YELLOW + f"Running up to {max_jobs} jobs at once "
+          + f"(CPU slots: {slot_limits['cpu']}, NVENC slots: {slot_limits['nvenc']}"
+          + (f", {cpu_threads} threads per CPU job" if cpu_threads > 0 else "") + ")"
+          + (", fewer while the CPU or memory is maxed out" if adaptive_jobs else "") + Style.RESET_ALL)
+
+# Process each file. Only queue_size files wait for a worker at a time, the rest are not even looked at yet.
+pool = ThreadPoolExecutor(max_workers=max_jobs)
+queue_slots = threading.BoundedSemaphore(queue_size)
+queued_jobs = set()
+
+def job_finished(future):
+    with counter_lock:
+        queued_jobs.discard(future)
+    queue_slots.release()
+
+def submit_job(input_file):
+    with phase_timer.phase("queue_full"):
+        queue_slots.acquire()
+    if staging is not None:
+        staging.prefetch(input_file)  # Copied to scratch while the files before it encode
+    future = pool.submit(run_job, input_file, time.perf_counter())
+    with counter_lock:
+        queued_jobs.add(future)
+    future.add_done_callback(job_finished)
+
+def retry_failed_outputs():
+    # Outputs that failed the verification are transcoded again
+    with counter_lock:
+        retry_files = list(verify_failed)
+        verify_failed.clear()
+    for input_file in retry_files:
+        submit_job(input_file)
+    return bool(retry_files)
+
+def take_over_expired_leases():
+    # If a node stops, its leases expire and the files are encoded here. Returns False once no file is left waiting.
+    global other_node_counter
+    with counter_lock:
+        waiting_files = list(leased_elsewhere)
+        leased_elsewhere.clear()
+    if not waiting_files:
+        return False
+    still_leased = []
+    for input_file in waiting_files:
+        state = lease_queue.state(input_file)
+        if state == "done":
+            with counter_lock:
+                other_node_counter += 1
+        elif state == "leased":
+            still_leased.append(input_file)
+        else:
+            log(Fore.YELLOW + f"Lease on {input_file} expired, processing it on this node" + Style.RESET_ALL)
+            submit_job(input_file)
+    with counter_lock:
+        leased_elsewhere.extend(still_leased)
+    if len(still_leased) == len(waiting_files):
+        stop_requested.wait(heartbeat_seconds)  # Nothing changed, check again after the next heartbeat
+    return True
+
+def drain_jobs():
+    # Wait for the queued jobs, the outputs being moved or verified, and the files other nodes were working on
+    while not stop_requested.is_set():
+        with counter_lock:
+            waiting_jobs = list(queued_jobs)
+        wait_for_futures(waiting_jobs)
+        with counter_lock:
+            outputs_pending = bool(unfinished_outputs)  # Read first, a failed output is queued for a retry before it is removed
+        if retry_failed_outputs():
+            continue
+        if outputs_pending:
+            stop_requested.wait(0.5)
+            continue
+        if lease_queue is None or not take_over_expired_leases():
+            return
+
+try:
+    for input_file in input_files:
+        if streaming:
+            with counter_lock:
+                total_files += 1
+        retry_failed_outputs()
+        submit_job(input_file)
+    discovery_finished.set()
+    drain_jobs()
+    pool.shutdown(wait=True)
+    if planner is not None:
+        planner.shutdown(wait=False, cancel_futures=True)  # Every file is done, the ETA isn't needed anymore
+except KeyboardInterrupt:
+    # ffmpeg receives the same Ctrl+C, let the running jobs wind down without marking them as failed
+    stop_requested.set()
+    with counter_lock:
+        waiting_jobs = list(queued_jobs)
+    for future in waiting_jobs:
+        future.cancel()
+    print(Fore.YELLOW + "\nStopping, waiting for running jobs to exit..." + Style.RESET_ALL)
+    if planner is not None:
+        planner.shutdown(wait=False, cancel_futures=True)
+    pool.shutdown(wait=True)
+    if staging is not None:
+        staging.close()  # Finishes moving the outputs that are done
+    if verifier is not None:
+        verifier.shutdown(wait=True, cancel_futures=True)  # Unchecked outputs are checked on the next run
+    if lease_queue is not None:
+        lease_queue.close()
+    resource_governor.close()
+    job_state.close()
+    progress_tracker.close()
+    sys.exit(1)
+if staging is not None:
+    print(Fore.YELLOW + "Waiting for the last outputs to be moved from the scratch folder..." + Style.RESET_ALL)
+    staging.close()
+if verifier is not None:
+    verifier.shutdown(wait=True)
+if lease_queue is not None:
+    lease_queue.close()
+resource_governor.close()
+job_state.close()
+progress_tracker.close()
+probe_cache.close()
 
 print(Fore.BLUE + "\n\nSUMMARY:\n" + Style.RESET_ALL)
 print(Fore.GREEN + f"Successfully transcoded: {success_counter}" + Style.RESET_ALL)
 print(Fore.GREEN + f"Wrong codec: {Fore.RED}{wrong_codec_counter}" + Style.RESET_ALL)
+if predict_size:
+    print(Fore.GREEN + f"Predicted not to shrink: {Fore.RED}{skipped_counter}" + Style.RESET_ALL)
+if verify_outputs:
+    print(Fore.GREEN + f"Outputs that failed the verification: {Fore.RED}{sum(verify_attempts.values())}" + Style.RESET_ALL)
+if detect_duplicates:
+    print(Fore.GREEN + f"Duplicates copied from an identical file: {duplicate_counter}" + Style.RESET_ALL)
 print(Fore.GREEN + f"Failed transcodings: {Fore.RED}{failed_counter}" + Style.RESET_ALL)
 print(Fore.GREEN + f"Total number of files handled: {total_files}" + Style.RESET_ALL)
 print(Fore.GREEN + f"Total time elapsed: {format_seconds_dynamically(total_seconds)}" + Style.RESET_ALL)
-print(Fore.BLUE + f"\nFINISHED PROCESSING ALL FILES\n" + Style.RESET_ALL)
\ No newline at end of file
+
+if lease_queue is not None:
+    # Results of every node that shares the queue folder, this one included
+    queue_summary = lease_queue.summary()
+    print(Fore.BLUE + f"\nALL NODES ({queue_folder}):\n" + Style.RESET_ALL)
+    print(Fore.GREEN + f"Handled by this node ({node_name}): {success_counter + failed_counter + wrong_codec_counter + skipped_counter}" + Style.RESET_ALL)
+    print(Fore.GREEN + f"Handled by other nodes: {other_node_counter}" + Style.RESET_ALL)
+    for status, count in sorted(queue_summary["status"].items()):
+        print(Fore.GREEN + f"{status.capitalize()}: {count}" + Style.RESET_ALL)
+    for node, count in sorted(queue_summary["nodes"].items()):
+        print(Fore.GREEN + f"Files finished by {node}: {count}" + Style.RESET_ALL)
+    print(Fore.GREEN + f"Encoding time over all nodes: {format_seconds_dynamically(int(queue_summary['seconds']))}" + Style.RESET_ALL)
+
+if timing_report:
+    print(Fore.BLUE + "\nTIME PER PHASE:\n" + Style.RESET_ALL)
+    print("\n".join(phase_timer.report_lines(max_jobs, slowest_files)))
+    phase_timer.write_report(timing_report_path, max_jobs, max(slowest_files, 20))
+if profiler.dump(profile_path):
+    print(Fore.YELLOW + f"Profile written to {profile_path} (python -m pstats {profile_path})" + Style.RESET_ALL)
+print(Fore.BLUE + f"\nFINISHED PROCESSING ALL FILES\n" + Style.RESET_ALL)
@@ -0,0 +1,323 @@
+import argparse
+import configparser
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from job_state import JobStateStore
+from media_probe import ProbeCache, summarize
+from resource_governor import x265_pools
+
+# Benchmarks for this machine:
+#   python benchmark.py encoders   Encodes generated test clips with every combination of encoder, preset, CRF
+#                                  and number of parallel jobs, and reports fps, output size and wall time.
+#   python benchmark.py overhead   Runs find_files.py and batch_transcoder.py on a generated library of empty
+#                                  files with a stub ffmpeg, to measure the scripts' own bookkeeping at scale.
+
+# Get path to settings.cfg file
+config = configparser.ConfigParser()
+script_dir = os.path.dirname(os.path.abspath(__file__))
+config_path = os.path.join(script_dir, 'settings.cfg')
+config.read(config_path)
+
+script_folder = config.get('Paths', 'script_folder', fallback=script_dir)
+default_encoders = config.get('Codecs', 'encoder', fallback="x264")
+default_preset = config.get('Transcoding settings', 'speed_preset', fallback="medium")
+default_crf = config.get('Transcoding settings', 'crf_quality', fallback="19")
+default_max_jobs = config.getint('Concurrency', 'max_jobs', fallback=1)
+
+encoder_mapping = {
+    "x264": "libx264",
+    "x264_nvenc": "h264_nvenc",
+    "x265": "libx265",
+    "x265_nvenc": "h265_nvenc"
+}
+cpu_encoders = ["libx264", "libx265"]
+
+# Scripts copied next to the generated settings.cfg for the overhead benchmark
+script_files = ["batch_transcoder.py", "find_files.py", "job_state.py", "media_probe.py", "scheduler.py",
+                "segment_encoder.py", "copy_engine.py", "encode_progress.py", "phase_timer.py", "size_predictor.py",
+                "scratch_staging.py", "shared_queue.py", "resource_governor.py", "duplicate_finder.py",
+                "output_verifier.py"]
+
+# ffprobe output of the files in the generated library, 10 minutes of 1080p HEVC with one audio stream
+stub_probe_output = (
+    '{"streams": ['
+    '{"index": 0, "codec_type": "video", "codec_name": "hevc", "profile": "Main", "pix_fmt": "yuv420p", '
+    '"width": 1920, "height": 1080, "avg_frame_rate": "25/1"}, '
+    '{"index": 1, "codec_type": "audio", "codec_name": "aac"}], '
+    '"format": {"format_name": "matroska,webm", "duration": "600.0", "bit_rate": "4000000"}}'
+)
+
+# The stub ffmpeg only creates the output file (always the last argument), which is all the scripts look at
+stub_ffmpeg = """#!/bin/sh
+for last in "$@"; do :; done
+: > "$last"
+"""
+stub_ffprobe = f"""#!/bin/sh
+echo '{stub_probe_output}'
+"""
+
+
+def split_list(value):
+    return [item.strip() for item in str(value).split(",") if item.strip()]
+
+
+def video_encoder_args(ffmpeg_encoder, preset, crf, threads):
+    # Same video settings as batch_transcoder.py
+    pixel_format = "yuv420p" if ffmpeg_encoder in ["libx264", "h264_nvenc"] else "yuv420p10le"
+    thread_args = []
+    if threads > 0 and ffmpeg_encoder in cpu_encoders:
+        thread_args = ["-threads", str(threads)]
+        if ffmpeg_encoder == "libx265":
+            thread_args += ["-x265-params", f"pools={x265_pools(threads)}"]
+    return ["-c:v", ffmpeg_encoder, "-crf", str(crf), "-preset", preset, *thread_args, "-pix_fmt", pixel_format]
+
+
+def generate_clip(clips_folder, resolution, duration, frame_rate):
+    """Create a test clip with ffmpeg's lavfi test source, reusing it if it already exists."""
+    clip_path = os.path.join(clips_folder, f"testsrc_{resolution}_{duration}s.mkv")
+    if not os.path.exists(clip_path):
+        os.makedirs(clips_folder, exist_ok=True)
+        print(f"Generating {clip_path}")
+        subprocess.run([
+            "ffmpeg", "-y",
+            "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate={frame_rate}:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-crf", "10", "-pix_fmt", "yuv420p",
+            "-c:a", "aac", "-shortest",
+            "-loglevel", "error", "-hide_banner", "-nostats",
+            clip_path
+        ], check=True)
+    return clip_path
+
+
+def run_encoder_benchmark(args):
+    encoders = []
+    for encoder_name in split_list(args.encoders):
+        ffmpeg_encoder = encoder_mapping.get(encoder_name.lower())
+        if ffmpeg_encoder is None:
+            print(f"Error: Unknown encoder {encoder_name}. Exiting.")
+            sys.exit()
+        encoders.append(ffmpeg_encoder)
+
+    work_dir = args.work_dir or os.path.join(script_folder, "benchmark")
+    clips_folder = os.path.join(work_dir, "clips")
+    outputs_folder = os.path.join(work_dir, "outputs")
+    os.makedirs(outputs_folder, exist_ok=True)
+
+    clips = []
+    for resolution in split_list(args.resolutions):
+        for duration in split_list(args.durations):
+            clip_path = generate_clip(clips_folder, resolution, int(duration), args.frame_rate)
+            clips.append((resolution, int(duration), clip_path))
+
+    results = []
+    for ffmpeg_encoder in encoders:
+        for preset in split_list(args.presets):
+            for crf in split_list(args.crfs):
+                for jobs in [int(jobs) for jobs in split_list(args.jobs)]:
+                    # Parallel CPU jobs split the cores like batch_transcoder.py does
+                    threads = max(1, (os.cpu_count() or 1) // jobs) if jobs > 1 else 0
+                    for resolution, duration, clip_path in clips:
+                        results.append(benchmark_settings(ffmpeg_encoder, preset, crf, jobs, threads,
+                                                          resolution, duration, clip_path, outputs_folder, args.frame_rate))
+
+    print(f"\n{'encoder':<12}{'preset':<11}{'crf':>4}{'jobs':>5}{'resolution':>12}{'wall s':>9}{'fps':>9}{'speed':>8}{'kbit/s':>10}{'size MB':>9}")
+    for result in results:
+        if result["failed"]:
+            print(f"{result['encoder']:<12}{result['preset']:<11}{result['crf']:>4}{result['jobs']:>5}{result['resolution']:>12}   failed")
+            continue
+        print(f"{result['encoder']:<12}{result['preset']:<11}{result['crf']:>4}{result['jobs']:>5}{result['resolution']:>12}"
+              f"{result['wall_seconds']:>9.2f}{result['fps']:>9.1f}{result['speed']:>7.2f}x"
+              f"{result['kbit_per_second']:>10.0f}{result['output_mb']:>9.2f}")
+
+    results_path = os.path.join(work_dir, "benchmark_results.csv")
+    with open(results_path, "w", newline="", encoding="utf-8") as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    print(f"\nResults written to {results_path}")
+
+
+def benchmark_settings(ffmpeg_encoder, preset, crf, jobs, threads, resolution, duration, clip_path, outputs_folder, frame_rate):
+    """Encode the clip jobs times at once and measure the throughput of all of them together."""
+    print(f"Encoding {os.path.basename(clip_path)} with {ffmpeg_encoder}, preset {preset}, CRF {crf}, {jobs} at once")
+
+    def encode(job_index):
+        output_path = os.path.join(outputs_folder, f"{ffmpeg_encoder}_{preset}_{crf}_{resolution}_{duration}s_{job_index}.mkv")
+        encode_cmd = [
+            "ffmpeg", "-y", "-i", clip_path, "-map", "0",
+            *video_encoder_args(ffmpeg_encoder, preset, crf, threads),
+            "-c:a", "copy", "-loglevel", "error", "-hide_banner", "-nostats",
+            output_path
+        ]
+        result = subprocess.run(encode_cmd)
+        return output_path if result.returncode == 0 else None
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        output_paths = list(pool.map(encode, range(jobs)))
+    wall_seconds = time.perf_counter() - start_time
+
+    failed = any(output_path is None for output_path in output_paths)
+    output_bytes = 0 if failed else os.path.getsize(output_paths[0])
+    for output_path in output_paths:
+        if output_path and os.path.exists(output_path):
+            os.remove(output_path)
+    return {
+        "encoder": ffmpeg_encoder,
+        "preset": preset,
+        "crf": crf,
+        "jobs": jobs,
+        "threads_per_job": threads,
+        "resolution": resolution,
+        "duration": duration,
+        "failed": failed,
+        "wall_seconds": round(wall_seconds, 3),
+        "fps": round(duration * frame_rate * jobs / wall_seconds, 2),  # All parallel jobs together
+        "speed": round(duration * jobs / wall_seconds, 3),
+        "kbit_per_second": round(output_bytes * 8 / duration / 1000, 1),
+        "output_mb": round(output_bytes / 1024 ** 2, 3),
+    }
+
+
+def write_overhead_settings(settings_path, input_folder, output_folder, scripts_folder, jobs):
+    settings = configparser.ConfigParser()
+    settings["Paths"] = {
+        "input_base_folder": input_folder,
+        "output_base_folder": output_folder,
+        "script_folder": scripts_folder,
+        "input_files_list_name": "input_files_list.txt",
+        "use_input_files_list": "True",
+    }
+    settings["Codecs"] = {"input_codec": "H265", "skip_codec_checking": "False", "encoder": "x265"}
+    settings["Transcoding settings"] = {"speed_preset": "medium", "crf_quality": "19"}
+    settings["Concurrency"] = {"max_jobs": str(jobs)}
+    settings["Profiling"] = {"timing_report": "True", "slowest_files": "5"}
+    settings["Other"] = {
+        "copy_files_of_wrong_codec": "False",
+        "verbose_information": "False",
+        "use_different_extension": "False",
+        "output_extension": "mkv",
+    }
+    with open(settings_path, "w", encoding="utf-8") as settings_file:
+        settings.write(settings_file)
+
+
+def create_library(input_folder, output_folder, files, files_per_folder, done_files, probe_cache, job_state):
+    """Create empty input files, cache their probe results and mark the first done_files of them as completed."""
+    probe_info = summarize(json.loads(stub_probe_output))
+    probe_cache.connection.execute("BEGIN")
+    job_state.connection.execute("BEGIN")
+    for file_index in range(files):
+        folder = os.path.join(input_folder, f"show_{file_index // files_per_folder:05d}")
+        if file_index % files_per_folder == 0:
+            os.makedirs(folder, exist_ok=True)
+        input_file = os.path.join(folder, f"episode_{file_index % files_per_folder:03d}.mkv")
+        with open(input_file, "wb") as file:
+            file.write(b"\0")
+        probe_cache.store(input_file, os.stat(input_file), dict(probe_info, size=1))
+        if file_index < done_files:
+            output_file = os.path.join(output_folder, os.path.relpath(input_file, input_folder))
+            job_state.mark(input_file, "completed", output_path=output_file, seconds=60, codec="hevc")
+    probe_cache.connection.execute("COMMIT")
+    job_state.connection.execute("COMMIT")
+
+
+def run_overhead_benchmark(args):
+    if os.name == "nt":
+        print("The overhead benchmark uses a shell script as stub ffmpeg and needs Linux or macOS. Exiting.")
+        sys.exit()
+
+    work_dir = args.work_dir or os.path.join(script_folder, "benchmark", "overhead")
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    input_folder = os.path.join(work_dir, "input")
+    output_folder = os.path.join(work_dir, "output")
+    scripts_folder = os.path.join(work_dir, "scripts")
+    stub_folder = os.path.join(work_dir, "bin")
+    for folder in (input_folder, output_folder, scripts_folder, stub_folder):
+        os.makedirs(folder, exist_ok=True)
+
+    for script_file in script_files:
+        shutil.copy2(os.path.join(script_dir, script_file), scripts_folder)
+    write_overhead_settings(os.path.join(scripts_folder, "settings.cfg"), input_folder, output_folder, scripts_folder, args.jobs)
+    for name, content in (("ffmpeg", stub_ffmpeg), ("ffprobe", stub_ffprobe)):
+        stub_path = os.path.join(stub_folder, name)
+        with open(stub_path, "w", encoding="utf-8") as stub_file:
+            stub_file.write(content)
+        os.chmod(stub_path, 0o755)
+
+    done_files = int(args.files * args.done_fraction)
+    print(f"Creating {args.files} files, {done_files} of them already transcoded...")
+    start_time = time.perf_counter()
+    probe_cache = ProbeCache(os.path.join(scripts_folder, "probe_cache.db"))
+    job_state = JobStateStore(os.path.join(scripts_folder, "job_state.db"))
+    create_library(input_folder, output_folder, args.files, args.files_per_folder, done_files, probe_cache, job_state)
+    probe_cache.close()
+    job_state.close()
+    print(f"Created in {time.perf_counter() - start_time:.1f} s\n")
+
+    environment = dict(os.environ, PATH=stub_folder + os.pathsep + os.environ.get("PATH", ""))
+    runs = [
+        ("scan", "find_files.py", "scan_timing_report.txt"),
+        ("rescan (incremental)", "find_files.py", "scan_timing_report.txt"),
+        (f"batch ({args.files - done_files} to encode)", "batch_transcoder.py", "timing_report.txt"),
+        ("batch (resume only)", "batch_transcoder.py", "timing_report.txt"),
+    ]
+    results = []
+    for name, script_file, report_name in runs:
+        print(f"Running {name}...")
+        start_time = time.perf_counter()
+        with open(os.path.join(work_dir, f"{script_file}.log"), "a", encoding="utf-8") as log_file:
+            result = subprocess.run([sys.executable, os.path.join(scripts_folder, script_file)], cwd=scripts_folder,
+                                    env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+        wall_seconds = time.perf_counter() - start_time
+        results.append((name, wall_seconds, result.returncode))
+
+        report_path = os.path.join(scripts_folder, report_name)
+        if os.path.exists(report_path):
+            with open(report_path, "r", encoding="utf-8") as report_file:
+                print(report_file.read())
+
+    print(f"{'run':<32}{'wall s':>9}{'files/s':>11}")
+    for name, wall_seconds, return_code in results:
+        failed = f"   exited with code {return_code}, see the log in {work_dir}" if return_code else ""
+        print(f"{name:<32}{wall_seconds:>9.2f}{args.files / wall_seconds:>11.0f}{failed}")
+
+    if not args.keep:
+        shutil.rmtree(work_dir)
+
+
+parser = argparse.ArgumentParser(description="Benchmarks for encoder settings and for the scripts' own overhead.")
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+encoders_parser = subparsers.add_parser("encoders", help="Encode test clips with a matrix of settings.")
+encoders_parser.add_argument("--encoders", default=default_encoders, help="Comma separated, e.g. x264,x265,x265_NVenc")
+encoders_parser.add_argument("--presets", default=default_preset, help="Comma separated, e.g. fast,medium,slow")
+encoders_parser.add_argument("--crfs", default=default_crf, help="Comma separated, e.g. 19,23")
+encoders_parser.add_argument("--jobs", default=",".join(sorted({"1", str(default_max_jobs)})),
+                             help="Comma separated numbers of encodes running at once")
+encoders_parser.add_argument("--resolutions", default="640x360,1280x720,1920x1080")
+encoders_parser.add_argument("--durations", default="10", help="Clip lengths in seconds, comma separated")
+encoders_parser.add_argument("--frame-rate", type=int, default=25)
+encoders_parser.add_argument("--work-dir", help="Folder for the clips and the results (default: benchmark in script_folder)")
+
+overhead_parser = subparsers.add_parser("overhead", help="Measure scanning and bookkeeping with a stub ffmpeg.")
+overhead_parser.add_argument("--files", type=int, default=100000)
+overhead_parser.add_argument("--files-per-folder", type=int, default=100)
+overhead_parser.add_argument("--done-fraction", type=float, default=0.99, help="Part of the files already transcoded")
+overhead_parser.add_argument("--jobs", type=int, default=default_max_jobs)
+overhead_parser.add_argument("--work-dir", help="Folder for the generated library (removed afterwards unless --keep)")
+overhead_parser.add_argument("--keep", action="store_true")
+
+args = parser.parse_args()
+if args.benchmark == "encoders":
+    run_encoder_benchmark(args)
+else:
+    run_overhead_benchmark(args)
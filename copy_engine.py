@@ -0,0 +1,128 @@
+import os
+import shutil
+import sys
+
+# ioctl request that clones a whole file on copy-on-write filesystems (Btrfs, XFS, ...) on Linux
+FICLONE = 0x40049409
+
+copy_buffer_size = 8 * 1024 * 1024
+copy_chunk_size = 1024 * 1024 * 1024  # copy_file_range and sendfile move at most this much per call
+
+
+def is_up_to_date(source_path, destination_path):
+    """Return True if the destination already has the size and modification time of the source."""
+    try:
+        source_stat = os.stat(source_path)
+        destination_stat = os.stat(destination_path)
+    except OSError:
+        return False
+    # FAT and SMB shares only keep the modification time to 2 seconds
+    return source_stat.st_size == destination_stat.st_size and abs(source_stat.st_mtime - destination_stat.st_mtime) < 2
+
+
+def same_filesystem(source_path, destination_folder):
+    try:
+        return os.stat(source_path).st_dev == os.stat(destination_folder).st_dev
+    except OSError:
+        return False
+
+
+def try_reflink(source_file, destination_file):
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def try_copy_file_range(source_file, destination_file, size):
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            sent = os.copy_file_range(source_file.fileno(), destination_file.fileno(), min(copy_chunk_size, size - copied))
+            if sent == 0:
+                break
+            copied += sent
+    except OSError:
+        if copied == 0:
+            return False  # Not supported here, nothing written yet
+        raise
+    return copied == size
+
+
+def try_sendfile(source_file, destination_file, size):
+    if not hasattr(os, "sendfile") or not sys.platform.startswith("linux"):
+        return False  # Only Linux supports sendfile between two regular files
+    copied = 0
+    try:
+        while copied < size:
+            sent = os.sendfile(destination_file.fileno(), source_file.fileno(), copied, min(copy_chunk_size, size - copied))
+            if sent == 0:
+                break
+            copied += sent
+    except OSError:
+        if copied == 0:
+            return False
+        raise
+    return copied == size
+
+
+def copy_contents(source_path, destination_path):
+    """Copy the file data with the fastest method available, returns the name of the method."""
+    size = os.path.getsize(source_path)
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        if try_reflink(source_file, destination_file):
+            return "reflink"
+        if try_copy_file_range(source_file, destination_file, size):
+            return "copy_file_range"
+        source_file.seek(0)
+        destination_file.seek(0)
+        destination_file.truncate()
+        if try_sendfile(source_file, destination_file, size):
+            return "sendfile"
+        source_file.seek(0)
+        destination_file.seek(0)
+        destination_file.truncate()
+        shutil.copyfileobj(source_file, destination_file, copy_buffer_size)
+        return "copy"
+
+
+def fast_copy(source_path, destination_path, use_hardlinks=True):
+    """Copy a file to its destination as cheaply as possible.
+
+    Destinations that already match the source in size and modification time are skipped. On the same
+    filesystem a hardlink is made if allowed, otherwise the data is reflinked or copied in the kernel
+    where possible. The copy is written under a temporary name and renamed, so an interrupted copy is
+    never left under the real name. Returns the method that was used.
+    """
+    if is_up_to_date(source_path, destination_path):
+        return "skipped"
+
+    destination_folder = os.path.dirname(destination_path)
+    temporary_path = destination_path + ".partial"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    if use_hardlinks and same_filesystem(source_path, destination_folder):
+        try:
+            os.link(source_path, temporary_path)
+            os.replace(temporary_path, destination_path)
+            return "hardlink"
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    try:
+        method = copy_contents(source_path, temporary_path)
+        shutil.copystat(source_path, temporary_path)  # Keeps the modification time for the up to date check
+        os.replace(temporary_path, destination_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return method
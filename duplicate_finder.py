@@ -0,0 +1,85 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read per block and number of blocks for the partial hash. The first and last block catch most
+# differences (headers, indexes), the blocks in between catch files that only differ in the middle.
+block_size = 1024 * 1024
+partial_blocks = 8
+
+
+def partial_hash(file_path, size):
+    """Hash the size and a few blocks spread over a file, so a large file is told apart with a few MB of reads."""
+    digest = hashlib.blake2b(str(size).encode("ascii"), digest_size=20)
+    with open(file_path, "rb") as file:
+        if size <= block_size * partial_blocks:
+            digest.update(file.read())
+            return digest.hexdigest()
+        step = (size - block_size) // (partial_blocks - 1)
+        for index in range(partial_blocks):
+            file.seek(index * step)
+            digest.update(file.read(block_size))
+    return digest.hexdigest()
+
+
+def full_hash(file_path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as file:
+        while True:
+            block = file.read(block_size * 8)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def group_by(files, key, workers):
+    # Files with the same key, in their original order. Files the key can't be computed for are left out.
+    groups = {}
+    with ThreadPoolExecutor(max_workers=workers) as hasher:
+        for file_path, value in zip(files, hasher.map(key, files)):
+            if value is not None:
+                groups.setdefault(value, []).append(file_path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(files, hash_cache=None, workers=4):
+    """Return the groups of files with identical contents, each in the order the files were given.
+
+    Files are grouped by size first, which rules out nearly everything without reading a byte. Files of the
+    same size are compared by a partial hash, and only files that also match there are hashed completely.
+    Hashes are looked up in and stored to hash_cache (see ProbeCache.lookup_hashes), so unchanged files are
+    not read again on later runs.
+    """
+    stats = {}
+    for file_path in files:
+        try:
+            stats[file_path] = os.stat(file_path)
+        except OSError:
+            pass
+
+    def cached_hash(file_path, kind, compute):
+        file_stat = stats[file_path]
+        cached = hash_cache.lookup_hashes(file_path, file_stat) if hash_cache else None
+        if cached and cached[kind]:
+            return cached[kind]
+        try:
+            value = compute()
+        except OSError:
+            return None
+        if hash_cache:
+            hash_cache.store_hashes(file_path, file_stat, **{kind: value})
+        return value
+
+    size_groups = group_by(list(stats), lambda file_path: stats[file_path].st_size or None, workers)
+    duplicates = []
+    for size_group in size_groups:
+        partial_groups = group_by(size_group, lambda file_path: cached_hash(
+            file_path, "partial_hash", lambda: partial_hash(file_path, stats[file_path].st_size)), workers)
+        for partial_group in partial_groups:
+            if stats[partial_group[0]].st_size <= block_size * partial_blocks:
+                duplicates.append(partial_group)  # The partial hash already covered the whole file
+                continue
+            duplicates.extend(group_by(partial_group, lambda file_path: cached_hash(
+                file_path, "full_hash", lambda: full_hash(file_path)), workers))
+    return duplicates
@@ -0,0 +1,241 @@
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+def parse_number(value, suffix=""):
+    # ffmpeg writes "N/A" until a value is known, and units like "kbits/s" or "x" after some numbers
+    value = (value or "").strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class ProgressTracker:
+    """Collects the progress of every running ffmpeg process and publishes it.
+
+    The same data is written as JSON lines events, as an OpenMetrics text file for monitoring to scrape,
+    and rendered on the console.
+    """
+
+    def __init__(self, events_path=None, metrics_path=None, metrics_interval=10, console_interval=0, console_lock=None):
+        self.events_path = events_path
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.console_interval = console_interval  # 0 rewrites a single status line, like ffmpeg's -stats
+        self.console_lock = console_lock or threading.Lock()
+        self.lock = threading.Lock()
+        self.metrics_lock = threading.Lock()  # One writer of metrics.prom at a time, they share the temporary file
+        self.jobs = {}  # job id -> latest progress of a running process
+        self.finished_counts = {}  # status -> number of finished jobs
+        self.encoded_bytes = 0
+        self.encoded_seconds = 0.0
+        self.last_metrics_write = 0
+        self.last_console_write = 0
+        self.events_file = open(events_path, "a", encoding="utf-8") if events_path else None
+
+    def close(self):
+        self.write_metrics(force=True)
+        with self.lock:
+            if self.events_file:
+                self.events_file.close()
+                self.events_file = None
+
+    def emit(self, event, **fields):
+        if not self.events_file:
+            return
+        line = json.dumps({"time": round(time.time(), 3), "event": event, **fields})
+        with self.lock:
+            if self.events_file:
+                try:
+                    self.events_file.write(line + "\n")
+                    self.events_file.flush()
+                except OSError:
+                    pass  # Monitoring must never fail an encode
+
+    def start(self, job_id, file_path, encoder=None, duration=None):
+        with self.lock:
+            self.jobs[job_id] = {
+                "file": file_path, "encoder": encoder, "duration": duration, "started_at": time.time(),
+                "frame": 0, "fps": 0.0, "speed": 0.0, "bitrate_kbps": 0.0, "out_size_bytes": 0,
+                "out_time_seconds": 0.0, "progress_ratio": 0.0,
+            }
+        self.emit("job_started", job=job_id, file=file_path, encoder=encoder, duration=duration)
+
+    def update(self, job_id, values):
+        """Apply one block of -progress output (the key=value lines up to a progress= line)."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            frame = parse_number(values.get("frame"))
+            fps = parse_number(values.get("fps"))
+            speed = parse_number(values.get("speed"), "x")
+            bitrate = parse_number(values.get("bitrate"), "kbits/s")
+            out_size = parse_number(values.get("total_size"))
+            out_time_us = parse_number(values.get("out_time_us") or values.get("out_time_ms"))  # Both are microseconds
+            if frame is not None:
+                job["frame"] = int(frame)
+            if fps is not None:
+                job["fps"] = fps
+            if speed is not None:
+                job["speed"] = speed
+            if bitrate is not None:
+                job["bitrate_kbps"] = bitrate
+            if out_size is not None:
+                job["out_size_bytes"] = int(out_size)
+            if out_time_us is not None and out_time_us >= 0:
+                job["out_time_seconds"] = out_time_us / 1_000_000
+                if job["duration"]:
+                    job["progress_ratio"] = min(job["out_time_seconds"] / job["duration"], 1.0)
+            snapshot = dict(job)
+
+        self.emit("progress", job=job_id, **{key: snapshot[key] for key in (
+            "file", "frame", "fps", "speed", "bitrate_kbps", "out_size_bytes", "out_time_seconds", "progress_ratio")})
+        self.write_metrics()
+        self.render_console()
+
+    def finish(self, job_id, status):
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            self.finished_counts[status] = self.finished_counts.get(status, 0) + 1
+            if job and status == "completed":
+                self.encoded_bytes += job["out_size_bytes"]
+                self.encoded_seconds += job["out_time_seconds"]
+        seconds = round(time.time() - job["started_at"], 3) if job else None
+        self.emit("job_finished", job=job_id, status=status, seconds=seconds,
+                  out_size_bytes=job["out_size_bytes"] if job else None)
+        self.write_metrics(force=True)
+
+    def aggregate(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {
+            "active_jobs": len(jobs),
+            "fps": sum(job["fps"] for job in jobs),
+            "speed": sum(job["speed"] for job in jobs),  # Seconds of video encoded per second, all jobs together
+            "bitrate_kbps": sum(job["bitrate_kbps"] for job in jobs),
+            "out_size_bytes": sum(job["out_size_bytes"] for job in jobs),
+        }
+
+    def write_metrics(self, force=False):
+        if not self.metrics_path:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_metrics_write < self.metrics_interval:
+                return
+            self.last_metrics_write = now
+        with self.metrics_lock:
+            try:
+                self._write_metrics_file()
+            except OSError:
+                pass  # Monitoring must never fail an encode
+
+    def _write_metrics_file(self):
+        with self.lock:
+            jobs = dict(self.jobs)
+            finished_counts = dict(self.finished_counts)
+            encoded_bytes = self.encoded_bytes
+            encoded_seconds = self.encoded_seconds
+        totals = self.aggregate()
+
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"# HELP {name} {help_text}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+                sample_name = name + "_total" if metric_type == "counter" else name
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+
+        metric("transcoder_active_jobs", "gauge", "Number of running ffmpeg processes.", [({}, totals["active_jobs"])])
+        metric("transcoder_fps", "gauge", "Frames per second of all running jobs together.", [({}, totals["fps"])])
+        metric("transcoder_speed", "gauge", "Speed multiplier of all running jobs together.", [({}, totals["speed"])])
+        metric("transcoder_job_fps", "gauge", "Frames per second of a running job.",
+               [({"job": job_id}, job["fps"]) for job_id, job in jobs.items()])
+        metric("transcoder_job_speed", "gauge", "Speed multiplier of a running job.",
+               [({"job": job_id}, job["speed"]) for job_id, job in jobs.items()])
+        metric("transcoder_job_bitrate_kbps", "gauge", "Output bitrate of a running job.",
+               [({"job": job_id}, job["bitrate_kbps"]) for job_id, job in jobs.items()])
+        metric("transcoder_job_out_size_bytes", "gauge", "Bytes written so far by a running job.",
+               [({"job": job_id}, job["out_size_bytes"]) for job_id, job in jobs.items()])
+        metric("transcoder_job_progress_ratio", "gauge", "Part of the source encoded so far by a running job.",
+               [({"job": job_id}, job["progress_ratio"]) for job_id, job in jobs.items()])
+        metric("transcoder_jobs_finished", "counter", "Finished jobs by status.",
+               [({"status": status}, count) for status, count in sorted(finished_counts.items())])
+        metric("transcoder_encoded_bytes", "counter", "Bytes written by completed jobs.", [({}, encoded_bytes)])
+        metric("transcoder_encoded_media_seconds", "counter", "Seconds of video encoded by completed jobs.",
+               [({}, round(encoded_seconds, 3))])
+        lines.append("# EOF")
+
+        # Replace the file in one step so a scraper never reads half of it
+        temporary_path = self.metrics_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, self.metrics_path)
+
+    def render_console(self):
+        now = time.time()
+        with self.lock:
+            if self.console_interval and now - self.last_console_write < self.console_interval:
+                return
+            self.last_console_write = now
+            jobs = list(self.jobs.values())
+        if not jobs:
+            return
+
+        def describe(job):
+            percent = f" {job['progress_ratio'] * 100:.0f}%" if job["duration"] else ""
+            return (f"frame={job['frame']} fps={job['fps']:.1f} bitrate={job['bitrate_kbps']:.1f}kbits/s "
+                    f"size={job['out_size_bytes'] / 1024 ** 2:.1f}MiB speed={job['speed']:.2f}x{percent}")
+
+        with self.console_lock:
+            if not self.console_interval:
+                if len(jobs) == 1:
+                    line = describe(jobs[0])
+                else:
+                    totals = self.aggregate()  # Segments of one file
+                    line = f"{totals['active_jobs']} processes: fps={totals['fps']:.1f} speed={totals['speed']:.2f}x"
+                print("\r" + line + "   ", end="", flush=True)
+            else:
+                totals = self.aggregate()
+                print(f"[{totals['active_jobs']} running, {totals['fps']:.1f} fps, {totals['speed']:.2f}x total]")
+                for job in jobs:
+                    print(f"   {os.path.basename(job['file'])}: {describe(job)}")
+
+
+def run_ffmpeg(ffmpeg_cmd, tracker, job_id):
+    """Run ffmpeg like subprocess.run(check=True), feeding its -progress output to the tracker."""
+    # The output file is always the last argument
+    progress_cmd = ffmpeg_cmd[:-1] + ["-progress", "pipe:1", ffmpeg_cmd[-1]]
+
+    process = subprocess.Popen(progress_cmd, stdout=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
+    try:
+        values = {}
+        for line in process.stdout:
+            key, separator, value = line.strip().partition("=")
+            if not separator:
+                continue
+            values[key] = value
+            if key == "progress":  # Last line of every block
+                tracker.update(job_id, values)
+                values = {}
+    except BaseException:
+        # Don't leave ffmpeg running on its own while the job is recorded as failed
+        process.kill()
+        process.wait()
+        raise
+    return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, progress_cmd)
@@ -1,7 +1,13 @@
 import os
 import configparser
-import subprocess
+import json
+import sqlite3
 import sys
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from media_probe import ProbeCache, ProbeError
+from phase_timer import PhaseTimer, ThreadProfiler
 
 # Get path to settings.cfg file
 config = configparser.ConfigParser()
@@ -15,8 +21,27 @@ script_folder = config.get('Paths', 'script_folder')
 input_files_list_name = config.get('Paths', 'input_files_list_name')
 input_codec = config.get('Codecs', 'input_codec').strip().lower()
 
+# Access variables in the Scan section (optional)
+scan_workers = config.getint('Scan', 'scan_workers', fallback=8)
+only_video_extensions = config.getboolean('Scan', 'only_video_extensions', fallback=True)
+incremental_scan = config.getboolean('Scan', 'incremental_scan', fallback=True)
+
+# Access variables in the Profiling section (optional)
+timing_report = config.getboolean('Profiling', 'timing_report', fallback=True)
+profile_run = config.getboolean('Profiling', 'profile', fallback=False)
+slowest_files = config.getint('Profiling', 'slowest_files', fallback=10)
+
+if "--full" in sys.argv:
+    incremental_scan = False  # Check every folder again, e.g. after files were replaced in place
+
 # Set paths
 files_list_path = os.path.join(script_folder, input_files_list_name)
+probe_cache_path = os.path.join(script_folder, "probe_cache.db")
+scan_state_path = os.path.join(script_folder, "scan_state.db")
+timing_report_path = os.path.join(script_folder, "scan_timing_report.txt")
+profile_path = os.path.join(script_folder, "find_files.pstats")
+
+video_extensions = (".mp4", ".mkv", ".avi", ".mov", ".flv", ".wmv")
 
 # Adjust input codec for FFMPEG
 codec_mapping = {
@@ -29,41 +54,138 @@ if ffmpeg_input_codec is None:
     print("Error: Invalid input codec specified in settings.cfg. Exiting.")
     sys.exit()
 
-def is_codec(codec, file_path):
+# ffprobe results are shared with batch_transcoder.py, so unchanged files are never probed twice
+probe_cache = ProbeCache(probe_cache_path)
+
+# Time spent in every phase of the scan, and an optional cProfile of it
+phase_timer = PhaseTimer(timing_report)
+profiler = ThreadProfiler(profile_run)
+
+def is_codec(codec, file_path, file_stat=None):
     try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name", "-of", "default=nw=1:nk=1", file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=10  # Timeout in seconds
-        )
-        return result.stdout.strip() == codec  # Direct codec comparison
-    except subprocess.TimeoutExpired:
-        print(f"Timeout checking file {file_path}. Skipping...")
-        return False
+        info = probe_cache.probe(file_path, timeout=10, file_stat=file_stat)  # Timeout in seconds
+        return info["codec_name"] == codec  # Direct codec comparison
+    except ProbeError as e:
+        print(f"Error checking file {file_path}: {e}. Skipping...")
+        return None
     except Exception as e:
         print(f"Error checking file {file_path}: {e}")
-        return False
+        return None
+
+
+class ScanProgress:
+    """Keeps track of how many files have been probed and prints the throughput now and then."""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_print = self.start_time
+        self.files_scanned = 0
+        self.bytes_scanned = 0
+        self.reused_files = 0  # Files in folders that were unchanged since the last scan
+
+    def add(self, file_size):
+        self.files_scanned += 1
+        self.bytes_scanned += file_size
+        now = time.time()
+        if now - self.last_print >= self.interval:
+            self.last_print = now
+            print(f"Progress: {self.summary()}")
+
+    def summary(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        scanned_gb = self.bytes_scanned / (1024 ** 3)
+        return (f"{self.files_scanned} files scanned ({self.files_scanned / elapsed:.1f} files/s), "
+                f"{scanned_gb:.2f} GB scanned ({scanned_gb / elapsed:.2f} GB/s)")
+
+
+class ScanState:
+    """Remembers every scanned directory, so unchanged directories don't have to be listed or probed again.
+
+    A directory's modification time changes whenever an entry is added, removed or renamed in it, so as
+    long as it is unchanged the stored subfolders and results are still valid.
+    """
+
+    def __init__(self, database_path):
+        self.connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, codec TEXT, subfolders TEXT, files TEXT)"
+        )
+
+    def get(self, path, mtime_ns, codec):
+        row = self.connection.execute(
+            "SELECT subfolders, files FROM directories WHERE path = ? AND mtime_ns = ? AND codec = ?",
+            (path, mtime_ns, codec),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def store(self, path, mtime_ns, codec, subfolders, files):
+        self.connection.execute(
+            "INSERT INTO directories (path, mtime_ns, codec, subfolders, files) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns, codec = excluded.codec, "
+            "subfolders = excluded.subfolders, files = excluded.files",
+            (path, mtime_ns, codec, json.dumps(subfolders), json.dumps(files)),
+        )
+
+    def remove_missing(self, input_base, visited):
+        # Forget directories below the input folder that don't exist anymore
+        self.connection.execute("BEGIN")
+        for (path,) in self.connection.execute("SELECT path FROM directories").fetchall():
+            if path not in visited and (path == input_base or path.startswith(os.path.join(input_base, ""))):
+                self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+        self.connection.execute("COMMIT")
+
+    def close(self):
+        self.connection.close()
+
+
+def check_file(file_path, file_stat):
+    """Return whether the file is of the wanted codec (None if it couldn't be read), and its size in bytes."""
+    with phase_timer.phase("probe", file_path):
+        return is_codec(ffmpeg_input_codec, file_path, file_stat), file_stat.st_size
+
+
+def list_folder(root):
+    """List a folder with os.scandir, returning its subfolders and the video files with their stat results."""
+    subfolders = []
+    files = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.name)
+                elif entry.is_file() and (not only_video_extensions or entry.name.lower().endswith(video_extensions)):
+                    files.append((entry.name, entry.stat()))  # Cached by scandir on Windows, one stat elsewhere
+            except OSError as e:
+                print(f"Error checking file {entry.path}: {e}")
+    return subfolders, files
 
 
 def find_codec_videos(codec, input_base, output_file):
     current_folder = None
     total_files = 0
     total_size_gb = 0.0
+    progress = ScanProgress()
+    with phase_timer.phase("scan_state"):
+        scan_state = ScanState(scan_state_path)
+    visited_folders = set()
+    reused_folders = 0
 
     # Ensure the output file is empty before starting
     open(output_file, 'w', encoding='utf-8').close()
 
-    for root, _, files in os.walk(input_base):
-        folder_size = 0  # Size of H265 files in the current folder (in bytes)
-        for name in files:
-            file_path = os.path.join(root, name)
-            print(f"Checking file: {file_path}")
-            if is_codec(ffmpeg_input_codec, file_path):
+    def write_folder(root, checked_files):
+        # Folders are written in the order they were found, even though probes finish out of order
+        nonlocal current_folder, total_files, total_size_gb
+        folder_size = 0  # Size of the matching files in the current folder (in bytes)
+        for name, (matches, file_size) in checked_files:
+            if matches:
+                file_path = os.path.join(root, name)
                 total_files += 1
-                # Get the file size in bytes
-                file_size = os.path.getsize(file_path)
                 folder_size += file_size
                 total_size_gb += file_size / (1024 ** 3)  # Convert bytes to GB
                 if current_folder != root:
@@ -72,7 +194,7 @@ def find_codec_videos(codec, input_base, output_file):
                             file.write("\n")
                     current_folder = root
                     print(f"Found {codec} files in folder: {current_folder}")
-                
+
                 # Write directly to the output file
                 with open(output_file, 'a', encoding='utf-8') as file:
                     file.write(f"{file_path}\n")
@@ -82,6 +204,93 @@ def find_codec_videos(codec, input_base, output_file):
             folder_size_gb = folder_size / (1024 ** 3)  # Convert folder size to GB
             print(f"Total size in folder '{root}': {folder_size_gb:.2f} GB")
 
+    pool = ThreadPoolExecutor(max_workers=scan_workers) if scan_workers > 1 else None
+    pending_folders = deque()  # Folders whose probes are still running, in walk order
+    pending_probes = 0
+
+    def write_oldest_folder():
+        nonlocal pending_probes
+        folder_root, folder_mtime_ns, subfolders, folder_probes, reused = pending_folders.popleft()
+        pending_probes -= len(folder_probes)
+        with phase_timer.phase("probe_wait", folder_root):
+            checked_files = [(name, probe.result()) for name, probe in folder_probes]
+        if reused:
+            with phase_timer.phase("write_list", folder_root):
+                write_folder(folder_root, checked_files)
+            return
+        for _, (_, file_size) in checked_files:
+            progress.add(file_size)
+        with phase_timer.phase("write_list", folder_root):
+            write_folder(folder_root, checked_files)
+
+        # A folder with unreadable files is scanned again next time
+        if all(matches is not None for _, (matches, _) in checked_files):
+            with phase_timer.phase("scan_state", folder_root):
+                scan_state.store(folder_root, folder_mtime_ns, codec, subfolders, checked_files)
+
+    def finished_probe(result):
+        probe = Future()
+        probe.set_result(result)
+        return probe
+
+    def probe_file(file_path, file_stat):
+        if pool is None:
+            print(f"Checking file: {file_path}")
+            return finished_probe(check_file(file_path, file_stat))
+        return pool.submit(profiler.profile_call, check_file, file_path, file_stat)
+
+    # Depth first, parents before their subfolders, like os.walk
+    folders_to_scan = [input_base]
+    while folders_to_scan:
+        root = folders_to_scan.pop()
+        visited_folders.add(root)
+        try:
+            with phase_timer.phase("stat_folder", root):
+                folder_mtime_ns = os.stat(root).st_mtime_ns
+        except OSError as e:
+            print(f"Error reading folder {root}: {e}")
+            continue
+
+        with phase_timer.phase("scan_state", root):
+            previous_scan = scan_state.get(root, folder_mtime_ns, codec) if incremental_scan else None
+        if previous_scan is not None:
+            # Nothing was added, removed or renamed here since the last scan
+            subfolders, checked_files = previous_scan
+            reused_folders += 1
+            progress.reused_files += len(checked_files)
+            folder_probes = [(name, finished_probe(tuple(result))) for name, result in checked_files]
+            pending_folders.append((root, folder_mtime_ns, subfolders, folder_probes, True))
+        else:
+            try:
+                with phase_timer.phase("list_folder", root):
+                    subfolders, files = list_folder(root)
+            except OSError as e:
+                print(f"Error reading folder {root}: {e}")
+                continue
+            folder_probes = [(name, probe_file(os.path.join(root, name), file_stat)) for name, file_stat in files]
+            pending_folders.append((root, folder_mtime_ns, subfolders, folder_probes, False))
+            pending_probes += len(folder_probes)
+
+        folders_to_scan.extend(os.path.join(root, name) for name in reversed(subfolders))
+
+        # Write the finished folders at the front of the queue, and wait for the oldest
+        # folder when too many probes are queued up so memory stays bounded
+        while pending_folders and (
+            pending_probes > scan_workers * 4
+            or all(probe.done() for _, probe in pending_folders[0][3])
+        ):
+            write_oldest_folder()
+
+    while pending_folders:
+        write_oldest_folder()
+
+    if pool is not None:
+        pool.shutdown()
+
+    with phase_timer.phase("scan_state"):
+        scan_state.remove_missing(input_base, visited_folders)
+        scan_state.close()
+
     # Write final summary to the output file
     with open(output_file, 'a', encoding='utf-8') as file:
         file.write(f"\nTotal {codec} files: {total_files}\n")
@@ -89,8 +298,21 @@ def find_codec_videos(codec, input_base, output_file):
 
     print(f"\nCompleted! Found {total_files} {codec} files.")
     print(f"Total size of all {codec} files: {total_size_gb:.2f} GB")
+    print(f"Scan speed: {progress.summary()}")
+    if incremental_scan:
+        print(f"Incremental scan: {reused_folders} of {len(visited_folders)} folders unchanged since the last scan "
+              f"({progress.reused_files} files not checked again)")
+    print(f"Probe cache: {probe_cache.hits} files unchanged since the last scan, {probe_cache.misses} probed")
+
+    if timing_report:
+        print("\nTime per phase:")
+        print("\n".join(phase_timer.report_lines(scan_workers, slowest_files)))
+        phase_timer.write_report(timing_report_path, scan_workers, max(slowest_files, 20))
 
 print("input_files_list_name: " + input_files_list_name)
 print("files_list_path: " + files_list_path)
 
+profiler.start_main()
 find_codec_videos(ffmpeg_input_codec, input_base_folder, files_list_path)
+if profiler.dump(profile_path):
+    print(f"Profile written to {profile_path} (python -m pstats {profile_path})")
@@ -0,0 +1,256 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Columns of the jobs table. New columns are added to older databases automatically when they are opened.
+job_columns = {
+    "input_path": "TEXT PRIMARY KEY",
+    "status": "TEXT NOT NULL",
+    "output_path": "TEXT",
+    "seconds": "INTEGER",
+    "codec": "TEXT",
+    "error": "TEXT",
+    "started_at": "REAL",
+    "finished_at": "REAL",
+    # Details of the source and the settings, used to predict encode times
+    "input_size": "INTEGER",
+    "duration": "REAL",
+    "height": "INTEGER",
+    "encoder": "TEXT",
+    "preset": "TEXT",
+    "crf": "INTEGER",
+    "output_size": "INTEGER",
+    # Output size and encode time extrapolated from sample encodes, and the video settings they were made with
+    "predicted_size": "INTEGER",
+    "predicted_seconds": "REAL",
+    "prediction_settings": "TEXT",
+    # Input file with the same contents whose output this file's output was made from
+    "duplicate_of": "TEXT",
+    # When the output was checked and the outcome ("passed" or the problem that was found)
+    "verified_at": "REAL",
+    "verification": "TEXT",
+}
+
+# Statuses that mean a file does not have to be processed again
+done_statuses = ("completed", "copied", "remuxed", "duplicate")
+
+
+class JobStateStore:
+    """Job state of every input file, stored in a SQLite database.
+
+    Every status change is its own transaction, so the database is never left half written when the
+    script is stopped. Lookups go through the primary key (input path) or the index on the output path.
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.lock:
+            columns = ", ".join(f"{name} {sql_type}" for name, sql_type in job_columns.items())
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS jobs ({columns})")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "input_path TEXT, segment_index INTEGER, fingerprint TEXT, status TEXT, path TEXT, finished_at REAL, "
+                "PRIMARY KEY (input_path, segment_index))"
+            )
+
+            # Add columns that were introduced after the database was created
+            existing = {row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")}
+            for name, sql_type in job_columns.items():
+                if name not in existing:
+                    self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {name} {sql_type}")
+
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_output_path ON jobs (output_path)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, input_path):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE input_path = ?", (input_path,)).fetchone()
+        return dict(row) if row else None
+
+    def find(self, input_path, output_path):
+        """Return the job of an input file, falling back to the output path used by imported rows."""
+        job = self.get(input_path)
+        if job is None and output_path:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT * FROM jobs WHERE output_path = ? ORDER BY finished_at DESC LIMIT 1", (output_path,)
+                ).fetchone()
+            job = dict(row) if row else None
+        return job
+
+    def mark(self, input_path, status, **fields):
+        """Atomically move a job to a new status, updating any of the other columns given."""
+        fields["status"] = status
+        if status != "transcoding":
+            fields.setdefault("finished_at", time.time())
+        unknown = set(fields) - set(job_columns)
+        if unknown:
+            raise ValueError(f"Unknown job columns: {', '.join(sorted(unknown))}")
+
+        names = ", ".join(["input_path"] + list(fields))
+        placeholders = ", ".join("?" * (len(fields) + 1))
+        updates = ", ".join(f"{name} = excluded.{name}" for name in fields)
+        with self.lock:
+            self.connection.execute(
+                f"INSERT INTO jobs ({names}) VALUES ({placeholders}) "
+                f"ON CONFLICT(input_path) DO UPDATE SET {updates}",
+                [input_path] + list(fields.values()),
+            )
+
+    def total_seconds(self):
+        with self.lock:
+            row = self.connection.execute("SELECT SUM(seconds) FROM jobs WHERE status = 'completed'").fetchone()
+        return int(row[0] or 0)
+
+    def history(self):
+        """Return the finished encodes that recorded their source details and settings."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM jobs WHERE status = 'completed' AND encoder IS NOT NULL"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def segments(self, input_path, fingerprint):
+        """Return the segment rows of a file, forgetting them if they belong to other settings or another version of the file."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT * FROM segments WHERE input_path = ? ORDER BY segment_index", (input_path,)
+            ).fetchall()
+            if any(row["fingerprint"] != fingerprint for row in rows):
+                self.connection.execute("DELETE FROM segments WHERE input_path = ?", (input_path,))
+                return []
+        return [dict(row) for row in rows]
+
+    def mark_segment(self, input_path, segment_index, fingerprint, status, path):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO segments (input_path, segment_index, fingerprint, status, path, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(input_path, segment_index) DO UPDATE SET "
+                "fingerprint = excluded.fingerprint, status = excluded.status, path = excluded.path, "
+                "finished_at = excluded.finished_at",
+                (input_path, segment_index, fingerprint, status, path, time.time()),
+            )
+
+    def clear_segments(self, input_path):
+        with self.lock:
+            self.connection.execute("DELETE FROM segments WHERE input_path = ?", (input_path,))
+
+    def import_legacy_files(self, completed_files_path, error_files_path, wrong_codec_files_path):
+        """One-time import of completed_files.txt, error_files.txt and wrong_codec_files.txt.
+
+        The old files only know the output path of completed and wrong codec files, so that path is used
+        as the key of those rows as well. Returns the number of imported lines, or None if the import
+        already happened before.
+        """
+        if self.get_meta("legacy_imported"):
+            return None
+
+        rows = []
+
+        # "<seconds> <output path>" or "copied <output path>"
+        if os.path.exists(completed_files_path):
+            with open(completed_files_path, "r", encoding="utf-8") as cf:
+                for line in cf:
+                    if not line.strip():
+                        continue
+                    try:
+                        seconds, file_path = line.split(" ", 1)
+                        file_path = file_path.strip()
+                        if seconds == "copied":
+                            rows.append((file_path, "copied", file_path, None, None, None))
+                        else:
+                            rows.append((file_path, "completed", file_path, int(seconds), None, None))
+                    except ValueError:
+                        print(f"Skipping malformed line in {completed_files_path}: {line.strip()}")
+
+        # "<reason>: <path>"
+        if os.path.exists(error_files_path):
+            with open(error_files_path, "r", encoding="utf-8") as cf:
+                for line in cf:
+                    reason, separator, file_path = line.strip().partition(": ")
+                    if separator:
+                        rows.append((file_path, "error", None, None, None, reason))
+
+        # "File is <codec>, not <codec>: <output path>"
+        if os.path.exists(wrong_codec_files_path):
+            with open(wrong_codec_files_path, "r", encoding="utf-8") as cf:
+                for line in cf:
+                    reason, separator, file_path = line.strip().partition(": ")
+                    if separator and reason.startswith("File is "):
+                        codec = reason[len("File is "):].split(",")[0]
+                        rows.append((file_path, "wrong_codec", file_path, None, codec, reason))
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Completed rows win over error rows of the same file, so they are never downgraded
+                self.connection.executemany(
+                    "INSERT INTO jobs (input_path, status, output_path, seconds, codec, error, finished_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(input_path) DO UPDATE SET "
+                    "status = CASE WHEN jobs.status IN ('completed', 'copied', 'remuxed') THEN jobs.status ELSE excluded.status END, "
+                    "seconds = COALESCE(jobs.seconds, excluded.seconds), "
+                    "codec = COALESCE(excluded.codec, jobs.codec), "
+                    "error = COALESCE(excluded.error, jobs.error)",
+                    [row + (now,) for row in rows],
+                )
+                self.connection.execute(
+                    "INSERT INTO meta (key, value) VALUES ('legacy_imported', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (str(now),),
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+
+class SegmentCheckpoint:
+    """Segment progress of one file, so an interrupted segmented encode continues where it stopped."""
+
+    def __init__(self, store, input_path, fingerprint):
+        self.store = store
+        self.input_path = input_path
+        self.fingerprint = fingerprint
+
+    def split_segments(self):
+        """Return the segment paths of an earlier split, or None if the file has not been split yet."""
+        rows = self.store.segments(self.input_path, self.fingerprint)
+        if not rows or not all(os.path.exists(row["path"]) for row in rows):
+            return None
+        return [row["path"] for row in rows]
+
+    def record_split(self, segment_paths):
+        for segment_index, segment_path in enumerate(segment_paths):
+            self.store.mark_segment(self.input_path, segment_index, self.fingerprint, "split", segment_path)
+
+    def encoded_segments(self):
+        """Return the indexes of the segments that finished encoding."""
+        rows = self.store.segments(self.input_path, self.fingerprint)
+        return {row["segment_index"] for row in rows if row["status"] == "encoded"}
+
+    def mark_encoded(self, segment_index, segment_path):
+        self.store.mark_segment(self.input_path, segment_index, self.fingerprint, "encoded", segment_path)
+
+    def clear(self):
+        self.store.clear_segments(self.input_path)
@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+
+class ProbeError(Exception):
+    """Raised when ffprobe can't read a file."""
+
+
+def run_ffprobe(file_path, timeout=None):
+    """Run a single JSON ffprobe on a file and return the information the scripts need."""
+    ffprobe_cmd = [
+        "ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path
+    ]
+    try:
+        result = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise ProbeError(f"Timeout reading {file_path}")
+    if result.returncode != 0:
+        raise ProbeError(result.stderr.strip() or f"ffprobe exited with code {result.returncode}")
+    try:
+        data = json.loads(result.stdout or "{}")
+    except ValueError as e:
+        raise ProbeError(f"Unreadable ffprobe output: {e}")
+    return summarize(data)
+
+
+def to_number(value, number_type=float):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_frame_rate(value):
+    # ffprobe writes frame rates as fractions like "24000/1001"
+    numerator, _, denominator = str(value or "").partition("/")
+    numerator, denominator = to_number(numerator), to_number(denominator or 1)
+    if not numerator or not denominator:
+        return None
+    return numerator / denominator
+
+
+def summarize(data):
+    """Reduce the ffprobe JSON output to the stream and format details that are cached."""
+    file_format = data.get("format", {})
+    streams = []
+    for stream in data.get("streams", []):
+        streams.append({
+            "index": stream.get("index"),
+            "codec_type": stream.get("codec_type"),
+            "codec_name": stream.get("codec_name"),
+            "profile": stream.get("profile"),
+            "pix_fmt": stream.get("pix_fmt"),
+            "width": to_number(stream.get("width"), int),
+            "height": to_number(stream.get("height"), int),
+            "frame_rate": parse_frame_rate(stream.get("avg_frame_rate")) or parse_frame_rate(stream.get("r_frame_rate")),
+            "bit_rate": to_number(stream.get("bit_rate"), int),
+            "duration": to_number(stream.get("duration")),
+        })
+
+    video = next((stream for stream in streams if stream["codec_type"] == "video"), {})
+    return {
+        "codec_name": video.get("codec_name") or "unknown",
+        "profile": video.get("profile") or "Unknown",
+        "pix_fmt": video.get("pix_fmt") or "Unknown",
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "frame_rate": video.get("frame_rate"),
+        "duration": to_number(file_format.get("duration")) or video.get("duration"),
+        "bit_rate": to_number(file_format.get("bit_rate"), int),
+        "format_name": file_format.get("format_name"),
+        "streams": streams,
+    }
+
+
+class ProbeCache:
+    """ffprobe results stored on disk, keyed by path, size and modification time.
+
+    As long as a file keeps its size and modification time the cached result is returned and
+    ffprobe is not started at all. Failed probes are not cached, so they are retried next time.
+    """
+
+    def __init__(self, database_path):
+        self.database_path = database_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS probes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, info TEXT, probed_at REAL)"
+            )
+            # Content hashes for the duplicate detection, kept apart so probing a file doesn't drop its hashes
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS hashes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, partial_hash TEXT, full_hash TEXT)"
+            )
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def lookup(self, file_path, file_stat):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT info FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, file_stat.st_size, file_stat.st_mtime_ns),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store(self, file_path, file_stat, info):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO probes (path, size, mtime_ns, info, probed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                "info = excluded.info, probed_at = excluded.probed_at",
+                (file_path, file_stat.st_size, file_stat.st_mtime_ns, json.dumps(info), time.time()),
+            )
+
+    def lookup_hashes(self, file_path, file_stat):
+        """Return {"partial_hash": ..., "full_hash": ...} of an unchanged file (either can be None), or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT partial_hash, full_hash FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, file_stat.st_size, file_stat.st_mtime_ns),
+            ).fetchone()
+        return {"partial_hash": row[0], "full_hash": row[1]} if row else None
+
+    def store_hashes(self, file_path, file_stat, partial_hash=None, full_hash=None):
+        # A hash that isn't given is kept, unless the file changed
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO hashes (path, size, mtime_ns, partial_hash, full_hash) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "partial_hash = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns "
+                "THEN COALESCE(excluded.partial_hash, partial_hash) ELSE excluded.partial_hash END, "
+                "full_hash = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns "
+                "THEN COALESCE(excluded.full_hash, full_hash) ELSE excluded.full_hash END, "
+                "size = excluded.size, mtime_ns = excluded.mtime_ns",
+                (file_path, file_stat.st_size, file_stat.st_mtime_ns, partial_hash, full_hash),
+            )
+
+    def probe(self, file_path, timeout=None, file_stat=None):
+        """Return the probe information of a file, only running ffprobe if the file changed."""
+        file_path = os.path.abspath(file_path)
+        try:
+            file_stat = file_stat or os.stat(file_path)
+        except OSError as e:
+            raise ProbeError(str(e))
+
+        info = self.lookup(file_path, file_stat)
+        with self.lock:
+            if info is not None:
+                self.hits += 1
+                return info
+            self.misses += 1
+
+        info = run_ffprobe(file_path, timeout=timeout)
+        info["size"] = file_stat.st_size
+        self.store(file_path, file_stat, info)
+        return info
@@ -0,0 +1,80 @@
+import os
+import random
+import subprocess
+from media_probe import ProbeError, run_ffprobe
+
+
+def stream_counts(probe_info):
+    counts = {}
+    for stream in probe_info.get("streams", []):
+        counts[stream["codec_type"]] = counts.get(stream["codec_type"], 0) + 1
+    return counts
+
+
+def check_output(output_info, source_info, output_size):
+    """Compare the probe information of an output with its source. Returns the problem found, or None."""
+    source_duration = source_info.get("duration")
+    output_duration = output_info.get("duration")
+    if source_duration:
+        if not output_duration:
+            return "Output has no duration"
+        if abs(output_duration - source_duration) > max(2.0, source_duration * 0.01):
+            return f"Output is {output_duration:.1f} s long, the source {source_duration:.1f} s"
+
+    source_counts, output_counts = stream_counts(source_info), stream_counts(output_info)
+    if not output_counts.get("video"):
+        return "Output has no video stream"
+    for stream_type in ("audio", "subtitle"):
+        if output_counts.get(stream_type, 0) != source_counts.get(stream_type, 0):
+            return f"Output has {output_counts.get(stream_type, 0)} {stream_type} streams, the source {source_counts.get(stream_type, 0)}"
+
+    # Even an efficient encode keeps more than 1% of the source, less means the data stopped coming
+    source_size = source_info.get("size")
+    if not output_size or (source_size and output_size < source_size * 0.01):
+        return f"Output is only {output_size} bytes"
+    return None
+
+
+def sample_windows(duration, samples, sample_seconds):
+    """Random windows, and always the end of the file, where a truncated or damaged copy usually shows."""
+    if samples < 1:
+        return []
+    if duration <= sample_seconds * samples:
+        return [0.0]
+    last_start = duration - sample_seconds
+    return sorted(random.uniform(0, last_start) for _ in range(samples - 1)) + [last_start]
+
+
+def decode_window(output_file, start, sample_seconds):
+    # -xerror stops at the first decoding error instead of concealing it
+    decode_cmd = [
+        "ffmpeg", "-v", "error", "-xerror", "-ss", f"{start:.3f}", "-i", output_file, "-t", str(sample_seconds),
+        "-map", "0:v:0", "-f", "null", "-"
+    ]
+    result = subprocess.run(decode_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0 or result.stderr.strip():
+        message = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"ffmpeg exited with code {result.returncode}"
+        return f"Decoding error at {start:.0f} s: {message}"
+    return None
+
+
+def verify_output(output_file, source_info, samples=3, sample_seconds=5):
+    """Check an encoded file: cheap checks of the container first, then decode a few short windows of the video.
+
+    Returns a description of the first problem found, or None if the output looks fine. The decode only
+    reads samples * sample_seconds of video, a fraction of what a full decode would take.
+    """
+    try:
+        output_info = run_ffprobe(output_file, timeout=60)
+    except ProbeError as e:
+        return f"Output can't be read: {e}"
+    problem = check_output(output_info, source_info, os.path.getsize(output_file))
+    if problem:
+        return problem
+
+    duration = output_info.get("duration") or source_info.get("duration") or 0
+    for start in sample_windows(duration, samples, sample_seconds):
+        problem = decode_window(output_file, start, sample_seconds)
+        if problem:
+            return problem
+    return None
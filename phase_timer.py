@@ -0,0 +1,150 @@
+import cProfile
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class PhaseTimer:
+    """Wall time spent in every phase of a run, e.g. probing, state writes or waiting for a worker.
+
+    Phases are measured with time.perf_counter and can be timed from any thread. The time is also added
+    up per item (a file or folder), so the slowest items can be listed at the end.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.durations = {}  # phase -> list of seconds, in the order the phases were first seen
+        self.item_seconds = {}  # item -> seconds over all phases
+        self.start_time = time.perf_counter()
+
+    def add(self, name, seconds, item=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.durations.setdefault(name, []).append(seconds)
+            if item is not None:
+                self.item_seconds[item] = self.item_seconds.get(item, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name, item=None):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, item)
+
+    def report_lines(self, workers=1, slowest=5):
+        """Return the breakdown of the run: totals and percentiles per phase, worker idle time and the slowest items."""
+        wall_seconds = time.perf_counter() - self.start_time
+        with self.lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+            item_seconds = dict(self.item_seconds)
+
+        lines = [f"{'phase':<18}{'count':>8}{'total s':>11}{'share':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        worker_seconds = wall_seconds * workers
+        for name, values in durations.items():
+            total = sum(values)
+            lines.append(
+                f"{name:<18}{len(values):>8}{total:>11.2f}{total / worker_seconds:>8.1%}"
+                f"{total / len(values) * 1000:>10.1f}{percentile(values, 0.5) * 1000:>10.1f}"
+                f"{percentile(values, 0.95) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}{values[-1] * 1000:>10.1f}"
+            )
+        lines.append(f"Wall time: {wall_seconds:.2f} s with {workers} worker{'s' if workers != 1 else ''}")
+
+        if "job" in durations:
+            busy_seconds = sum(durations["job"])
+            idle_seconds = max(worker_seconds - busy_seconds, 0.0)
+            lines.append(f"Worker idle time: {idle_seconds:.2f} s ({idle_seconds / worker_seconds:.1%} of the worker time)")
+
+        if item_seconds and slowest:
+            lines.append(f"Slowest {min(slowest, len(item_seconds))}:")
+            for item, seconds in sorted(item_seconds.items(), key=lambda pair: pair[1], reverse=True)[:slowest]:
+                lines.append(f"   {seconds:10.2f} s  {item}")
+        return lines
+
+    def write_report(self, report_path, workers=1, slowest=20):
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            report_file.write("\n".join(self.report_lines(workers, slowest)) + "\n")
+
+
+class ThreadProfiler:
+    """cProfile for a program with worker threads.
+
+    Up to Python 3.11 cProfile only sees the thread it was enabled in, so every call made through profile_call
+    gets its own profiler and all of them are merged into one pstats file at the end. From 3.12 on cProfile is
+    built on sys.monitoring, which sees every thread but allows only one active profiler, so a single profiler
+    is enabled for the whole run instead.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.single_profiler = sys.version_info >= (3, 12)
+        self.lock = threading.Lock()
+        self.profilers = []
+
+    def _enable(self, profiler):
+        # Another profiling tool (a debugger, coverage) can hold sys.monitoring, the run goes on without profiling then
+        try:
+            profiler.enable()
+        except ValueError as e:
+            print(f"Warning: profiling turned off, {e}")
+            self.enabled = False
+            return False
+        self.profilers.append(profiler)
+        return True
+
+    def _start_single(self):
+        with self.lock:
+            if self.enabled and not self.profilers:
+                self._enable(cProfile.Profile())
+
+    def profile_call(self, function, *args):
+        if not self.enabled:
+            return function(*args)
+        if self.single_profiler:
+            self._start_single()
+            return function(*args)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args)
+        finally:
+            with self.lock:
+                self.profilers.append(profiler)
+
+    def start_main(self):
+        # Profiles the main thread (discovery, planning and the submission loop) until dump
+        if not self.enabled:
+            return
+        if self.single_profiler:
+            self._start_single()
+            return
+        with self.lock:
+            self._enable(cProfile.Profile())
+
+    def dump(self, stats_path):
+        """Write the merged profile, readable with "python -m pstats <file>" or snakeviz. Returns False if there is none."""
+        with self.lock:
+            profilers = list(self.profilers)
+        for profiler in profilers:
+            profiler.disable()
+        profilers = [profiler for profiler in profilers if profiler.getstats()]
+        if not profilers:
+            return False
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(stats_path)
+        return True
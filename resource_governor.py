@@ -0,0 +1,223 @@
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import psutil  # Optional, the fallbacks below cover Linux and Windows
+except ImportError:
+    psutil = None
+
+
+class CpuSampler:
+    """CPU utilization in percent over the time since the previous sample, None if it can't be measured."""
+
+    def __init__(self):
+        self.previous = self._times()
+        if psutil is not None:
+            psutil.cpu_percent(interval=None)  # The first call only sets the starting point
+
+    def _times(self):
+        # (idle, total) CPU time of the whole system
+        if psutil is not None:
+            return None
+        if sys.platform.startswith("linux"):
+            try:
+                with open("/proc/stat", "r", encoding="ascii") as stat_file:
+                    values = [int(value) for value in stat_file.readline().split()[1:]]
+            except (OSError, ValueError):
+                return None
+            return values[3] + values[4], sum(values)  # idle + iowait
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+            idle, kernel, user = wintypes.FILETIME(), wintypes.FILETIME(), wintypes.FILETIME()
+            if not ctypes.windll.kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+                return None
+            as_int = lambda filetime: (filetime.dwHighDateTime << 32) | filetime.dwLowDateTime
+            return as_int(idle), as_int(kernel) + as_int(user)  # Kernel time includes the idle time
+        return None
+
+    def sample(self):
+        if psutil is not None:
+            return psutil.cpu_percent(interval=None)
+        current = self._times()
+        previous, self.previous = self.previous, current
+        if current is None or previous is None or current[1] <= previous[1]:
+            if hasattr(os, "getloadavg"):
+                return min(os.getloadavg()[0] / (os.cpu_count() or 1) * 100, 100.0)
+            return None
+        return 100.0 * (1 - (current[0] - previous[0]) / (current[1] - previous[1]))
+
+
+def available_memory():
+    """Return the memory available to new processes in bytes, None if it can't be measured."""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/meminfo", "r", encoding="ascii") as meminfo_file:
+                for line in meminfo_file:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            return None
+    if sys.platform == "win32":
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    return None
+
+
+def numa_node_count():
+    """Number of NUMA nodes (CPU sockets on most machines), 1 if it can't be detected."""
+    if sys.platform.startswith("linux"):
+        try:
+            nodes = [name for name in os.listdir("/sys/devices/system/node") if name[4:].isdigit() and name.startswith("node")]
+        except OSError:
+            return 1
+        return max(len(nodes), 1)
+    if sys.platform == "win32":
+        import ctypes
+        highest_node = ctypes.c_ulong()
+        if ctypes.windll.kernel32.GetNumaHighestNodeNumber(ctypes.byref(highest_node)):
+            return highest_node.value + 1
+    return 1
+
+
+def x265_pools(threads):
+    """Value of the x265 pools parameter that limits an encode to about threads threads in total.
+
+    A single number in pools means that many threads on NUMA node 0 only, so on a machine with several
+    sockets every encode would share the first one. The threads are spread over all nodes instead.
+    """
+    nodes = numa_node_count()
+    threads_per_node = max(1, -(-threads // nodes))
+    return ",".join([str(threads_per_node)] * nodes)
+
+
+def free_space(folder):
+    while not os.path.exists(folder) and os.path.dirname(folder) != folder:
+        folder = os.path.dirname(folder)  # The output folder is only created with the first output
+    try:
+        return shutil.disk_usage(folder).free
+    except OSError:
+        return None
+
+
+class NotEnoughSpaceError(Exception):
+    pass
+
+
+class ResourceGovernor:
+    """Limits the number of encodes by the memory and CPU headroom, and the outputs by the free space.
+
+    With adaptive set, the load is sampled every sample_seconds and the number of encodes allowed at once
+    goes down by one while the available memory is below min_free_memory, and up by one (to max_jobs) once
+    there is memory again and the CPU is below max_cpu_percent. A busy CPU alone doesn't lower the limit,
+    the encodes are meant to keep it busy. Running encodes are never stopped.
+
+    Before an encode starts, its predicted output size is reserved on the output volume. An encode that
+    would leave less than min_free_space waits while other outputs are being written, as their reservations
+    may be larger than the outputs turn out, and fails with NotEnoughSpaceError if nothing else could free space.
+    """
+
+    def __init__(self, max_jobs, output_folder, adaptive=True, max_cpu_percent=95, min_free_memory=0,
+                 min_free_space=0, sample_seconds=5, stop_requested=None, log=print):
+        self.max_jobs = max_jobs
+        self.output_folder = output_folder
+        self.adaptive = adaptive
+        self.max_cpu_percent = max_cpu_percent
+        self.min_free_memory = min_free_memory
+        self.min_free_space = min_free_space
+        self.sample_seconds = sample_seconds
+        self.stop_requested = stop_requested or threading.Event()
+        self.log = log
+        self.limit = max_jobs
+        self.running = set()
+        self.reserved = {}  # input file -> reserved bytes on the output volume
+        self.cpu_percent = None
+        self.memory = None
+        self.condition = threading.Condition()
+        self.closed = threading.Event()
+        self.cpu_sampler = CpuSampler()
+        if adaptive:
+            self.sampler_thread = threading.Thread(target=self._sample_loop, daemon=True)
+            self.sampler_thread.start()
+
+    def _sample_loop(self):
+        while not self.closed.wait(self.sample_seconds):
+            cpu_percent = self.cpu_sampler.sample()
+            memory = available_memory()
+            with self.condition:
+                self.cpu_percent, self.memory = cpu_percent, memory
+                memory_low = memory is not None and memory < self.min_free_memory
+                if memory_low:
+                    self.limit = max(self.limit - 1, 1)
+                elif self.limit < self.max_jobs and len(self.running) >= self.limit and \
+                        (cpu_percent is None or cpu_percent < self.max_cpu_percent):
+                    self.limit += 1
+                self.condition.notify_all()
+
+    def acquire(self, input_file):
+        """Wait until one more encode is allowed. Returns False if the script is being stopped."""
+        with self.condition:
+            while len(self.running) >= self.limit:
+                if self.stop_requested.is_set():
+                    return False
+                self.condition.wait(1)
+            self.running.add(input_file)
+            return True
+
+    def reserve(self, input_file, output_bytes):
+        """Wait until output_bytes fit on the output volume next to the outputs being written.
+        Returns False if the script is being stopped, raises NotEnoughSpaceError if the output can't fit."""
+        paused = False
+        with self.condition:
+            while True:
+                free = free_space(self.output_folder)
+                if free is None or free - sum(self.reserved.values()) - output_bytes >= self.min_free_space:
+                    break
+                if not any(reserved_file != input_file for reserved_file in self.reserved):
+                    raise NotEnoughSpaceError(
+                        f"Not enough free space on the output drive: {output_bytes / 1024 ** 3:.2f} GB predicted, "
+                        f"{free / 1024 ** 3:.2f} GB free and {self.min_free_space / 1024 ** 3:.2f} GB to keep free")
+                if not paused:
+                    self.log(f"Not enough free space for the output of {input_file} "
+                             f"({output_bytes / 1024 ** 3:.2f} GB predicted, {free / 1024 ** 3:.2f} GB free), waiting for the outputs being written...")
+                    paused = True
+                if self.stop_requested.is_set():
+                    return False
+                self.condition.wait(self.sample_seconds)
+            self.reserved[input_file] = output_bytes
+        if paused:
+            self.log(f"Free space is back, continuing with {input_file}")
+        return True
+
+    def finish_encode(self, input_file):
+        with self.condition:
+            self.running.discard(input_file)
+            self.condition.notify_all()
+
+    def release_space(self, input_file):
+        # Once the output is in place the free space of the volume accounts for it
+        with self.condition:
+            self.reserved.pop(input_file, None)
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return self.limit, self.cpu_percent, self.memory
+
+    def close(self):
+        self.closed.set()
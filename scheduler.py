@@ -0,0 +1,253 @@
+import statistics
+import threading
+import time
+
+# Orders the pending jobs can be processed in
+job_orders = ("list", "largest_first", "shortest_first")
+
+# Encode time of every preset relative to medium, roughly what x264 and x265 take. Used to predict presets
+# that have no history of their own from the presets that do.
+preset_relative_time = {
+    "ultrafast": 0.15,
+    "superfast": 0.2,
+    "veryfast": 0.3,
+    "faster": 0.5,
+    "fast": 0.7,
+    "medium": 1.0,
+    "slow": 1.6,
+    "slower": 3.0,
+    "veryslow": 6.0,
+    "placebo": 15.0,
+}
+preset_order = list(preset_relative_time)  # From the fastest to the slowest
+# The x264/x265 preset names NVENC accepts too. NVENC rejects the others, they are replaced by the closest of these.
+nvenc_presets = ("fast", "medium", "slow")
+
+# Every preset with the others from the closest to the farthest, to predict it from the nearest preset with history
+closest_presets = {
+    preset: sorted(preset_order, key=lambda other: abs(preset_order.index(other) - preset_order.index(preset)))
+    for preset in preset_order
+}
+
+
+def resolution_class(height):
+    if not height:
+        return "unknown"
+    if height < 720:
+        return "sd"
+    if height <= 1080:
+        return "hd"
+    return "uhd"
+
+
+class ThroughputModel:
+    """Predicts how long a file takes to encode from the encode times of earlier runs.
+
+    Samples are grouped by encoder, preset and resolution. A prediction uses the most specific group
+    that has samples, in seconds per source minute when the duration is known and seconds per GB otherwise.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.per_minute = {}  # group -> list of encode seconds per source minute
+        self.per_gb = {}      # group -> list of encode seconds per GB of source
+        self.size_ratios = {}  # (encoder,) or () -> list of output size / input size
+        self.medians = {}  # (samples dict id, group) -> median, dropped when the group gets a new sample
+
+    @staticmethod
+    def groups(encoder, preset, height):
+        # From the most to the least specific group
+        resolution = resolution_class(height)
+        return [(encoder, preset, resolution), (encoder, preset), (encoder,), ()]
+
+    def add_sample(self, encoder, preset, height, duration, size, seconds):
+        if not seconds or seconds <= 0:
+            return
+        with self.lock:
+            for group in self.groups(encoder, preset, height):
+                if duration:
+                    self.per_minute.setdefault(group, []).append(seconds / (duration / 60))
+                    self.medians.pop(("per_minute", group), None)
+                if size:
+                    self.per_gb.setdefault(group, []).append(seconds / (size / 1024 ** 3))
+                    self.medians.pop(("per_gb", group), None)
+
+    def add_output_size(self, encoder, input_size, output_size):
+        if not input_size or not output_size:
+            return
+        with self.lock:
+            for group in ((encoder,), ()):
+                self.size_ratios.setdefault(group, []).append(output_size / input_size)
+
+    def predict_output_size(self, encoder, input_size):
+        """Return a generous estimate of the output size: the input size times the output to input ratio that 90%
+        of the earlier files of the encoder stayed under. Without history the output is assumed as large as the input."""
+        with self.lock:
+            ratios = sorted(self.size_ratios.get((encoder,)) or self.size_ratios.get(()) or [1.0])
+        return int(input_size * ratios[int(0.9 * (len(ratios) - 1))])
+
+    def sample_count(self):
+        with self.lock:
+            return max(len(self.per_minute.get((), [])), len(self.per_gb.get((), [])))
+
+    def median(self, kind, group):
+        # Call with the lock held. Predictions are made for every pending file, the medians only change with new samples.
+        key = (kind, group)
+        if key not in self.medians:
+            self.medians[key] = statistics.median(getattr(self, kind)[group])
+        return self.medians[key]
+
+    def predict_group(self, group, duration, size):
+        # Call with the lock held
+        if duration and self.per_minute.get(group):
+            return self.median("per_minute", group) * duration / 60
+        if size and self.per_gb.get(group):
+            return self.median("per_gb", group) * size / 1024 ** 3
+        return None
+
+    def predict(self, encoder, preset, height, duration, size):
+        """Return the predicted encode time in seconds, or None without any usable history."""
+        with self.lock:
+            for group in self.groups(encoder, preset, height):
+                predicted = self.predict_group(group, duration, size)
+                if predicted is not None:
+                    return predicted
+        return None
+
+    def predict_preset(self, encoder, preset, height, duration, size):
+        """Like predict, but a preset without history of its own is predicted from the closest preset of the
+        same encoder that has history, scaled by their relative encode times."""
+        if preset not in preset_relative_time:
+            return self.predict(encoder, preset, height, duration, size)
+        resolution = resolution_class(height)
+        with self.lock:
+            for specific in (True, False):
+                for other in closest_presets[preset]:
+                    group = (encoder, other, resolution) if specific else (encoder, other)
+                    predicted = self.predict_group(group, duration, size)
+                    if predicted is not None:
+                        return predicted * preset_relative_time[preset] / preset_relative_time[other]
+        return self.predict(encoder, preset, height, duration, size)
+
+    @classmethod
+    def from_history(cls, history):
+        """Fit the model from finished jobs, see JobStateStore.history()."""
+        model = cls()
+        for job in history:
+            seconds = job["seconds"]
+            if job["started_at"] and job["finished_at"]:
+                seconds = job["finished_at"] - job["started_at"]  # More precise than the rounded seconds
+            model.add_sample(job["encoder"], job["preset"], job["height"], job["duration"], job["input_size"], seconds)
+            model.add_output_size(job["encoder"], job["input_size"], job["output_size"])
+        return model
+
+
+def order_jobs(jobs, job_order):
+    """Sort (input_file, predicted_seconds) pairs. Largest first keeps parallel workers from waiting
+    on one long file at the end of the batch, shortest first finishes as many files as possible early."""
+    if job_order == "largest_first":
+        return sorted(jobs, key=lambda job: job[1] or 0, reverse=True)
+    if job_order == "shortest_first":
+        return sorted(jobs, key=lambda job: job[1] or 0)
+    return list(jobs)
+
+
+class BatchEta:
+    """Keeps track of the work left in the batch.
+
+    Predictions are made every time the ETA is asked for, so they improve as the model learns from
+    the files that finish during the run. A prediction is linear in the duration and size of a file, so
+    the pending files are kept as sums per encoder, preset and resolution class, and the ETA takes one
+    prediction per group instead of one per file.
+    """
+
+    def __init__(self, max_jobs, predict):
+        self.max_jobs = max_jobs
+        self.predict = predict  # Function (encoder, preset, height, duration, size) -> predicted seconds, or None
+        self.lock = threading.Lock()
+        self.pending = {}  # input file -> (group key, duration, size), not started yet
+        self.pending_groups = {}  # group key -> [height, duration sum, size sum, file count]
+        self.running = {}  # input file -> ((encoder, preset, height, duration, size), start time)
+
+    @staticmethod
+    def group_key(probe_info, encoder, preset):
+        # Files that aren't encoded (wrong codec, unreadable) count as jobs that take no time
+        if not probe_info:
+            return None
+        return (encoder, preset, resolution_class(probe_info.get("height")),
+                bool(probe_info.get("duration")), bool(probe_info.get("size")))
+
+    def _remove_pending(self, input_file):
+        # Call with the lock held
+        entry = self.pending.pop(input_file, None)
+        if entry is None:
+            return
+        key, duration, size = entry
+        group = self.pending_groups[key]
+        group[1] -= duration
+        group[2] -= size
+        group[3] -= 1
+        if group[3] == 0:
+            del self.pending_groups[key]
+
+    def add(self, input_file, probe_info, encoder=None, preset=None):
+        """Add a file that hasn't started. encoder and preset are None until they are known."""
+        key = self.group_key(probe_info, encoder, preset)
+        duration = probe_info.get("duration") or 0 if probe_info else 0
+        size = probe_info.get("size") or 0 if probe_info else 0
+        with self.lock:
+            self._remove_pending(input_file)
+            self.pending[input_file] = (key, duration, size)
+            group = self.pending_groups.setdefault(key, [probe_info.get("height") if probe_info else None, 0, 0, 0])
+            group[1] += duration
+            group[2] += size
+            group[3] += 1
+
+    def start(self, input_file, probe_info, encoder, preset):
+        with self.lock:
+            self._remove_pending(input_file)
+            details = (encoder, preset, probe_info.get("height"), probe_info.get("duration"), probe_info.get("size"))
+            self.running[input_file] = (details, time.time())
+
+    def finish(self, input_file):
+        with self.lock:
+            self._remove_pending(input_file)
+            self.running.pop(input_file, None)
+
+    def seconds_left(self, default_encoder=None, preset=None):
+        """Return the predicted wall time left, or None while there is no history to predict from.
+        default_encoder is used for the pending files without an encoder, preset (if given) for all of them,
+        e.g. to try another preset."""
+        with self.lock:
+            pending_groups = [(key, tuple(group)) for key, group in self.pending_groups.items()]
+            running = list(self.running.values())
+        jobs_left = sum(group[3] for _, group in pending_groups) + len(running)
+        if jobs_left == 0:
+            return 0
+
+        work_left = 0
+        for key, (height, duration, size, _) in pending_groups:
+            if key is None:
+                continue
+            encoder, group_preset = key[0] or default_encoder, preset or key[1]
+            predicted = self.predict(encoder, group_preset, height, duration if key[3] else None, size if key[4] else None)
+            if predicted is None:
+                return None
+            work_left += predicted
+        for details, start_time in running:
+            predicted = self.predict(*details)
+            if predicted is None:
+                return None
+            work_left += max(predicted - (time.time() - start_time), 0)
+
+        # Work is split over the workers, but never over more workers than there are files left
+        return work_left / min(self.max_jobs, jobs_left)
+
+
+def choose_preset(presets, fits):
+    """Return the first preset (ordered from the slowest to the fastest) for which fits(preset) is True,
+    or the fastest one if none fits."""
+    for preset in presets:
+        if fits(preset):
+            return preset
+    return presets[-1]
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from copy_engine import fast_copy
+
+
+def scratch_name(file_path):
+    # Keeps the file name (and with it the extension ffmpeg looks at) in a folder of its own
+    return os.path.join(hashlib.sha1(file_path.encode("utf-8")).hexdigest()[:16], os.path.basename(file_path))
+
+
+class ScratchStaging:
+    """Copies the next inputs to a local scratch folder while the current files encode, and moves the
+    outputs written to scratch to their real location in the background.
+
+    Inputs are prefetched in the order prefetch() is called, at most prefetch_count ahead of the files
+    being encoded. Staged inputs and outputs waiting to be moved share a budget of budget_bytes. A file
+    that is not staged in time, or doesn't fit in the budget, is simply read from its original location.
+    """
+
+    def __init__(self, scratch_folder, budget_bytes, prefetch_count, should_stage=None):
+        self.inputs_folder = os.path.join(scratch_folder, "inputs")
+        self.outputs_folder = os.path.join(scratch_folder, "outputs")
+        self.budget_bytes = budget_bytes
+        self.prefetch_count = prefetch_count
+        self.should_stage = should_stage  # Function telling whether a file will be encoded at all
+        self.condition = threading.Condition()
+        self.reserved_bytes = 0
+        self.candidates = deque()  # Inputs to prefetch, in the order they will be encoded
+        self.checking = None  # Input taken from the candidates, not copying yet
+        self.staging = {}   # input -> size, copy in progress
+        self.staged = {}    # input -> (local path, size), ready and not used yet
+        self.in_use = {}    # input -> (local path, size), being encoded
+        self.cancelled = set()  # Inputs used or released before their prefetch finished
+        self.outputs = {}   # scratch output -> reserved size
+        self.closed = False
+
+        # Whatever is left from an earlier run can't be used, outputs without a finished move are encoded again
+        shutil.rmtree(self.inputs_folder, ignore_errors=True)
+        shutil.rmtree(self.outputs_folder, ignore_errors=True)
+        os.makedirs(self.inputs_folder, exist_ok=True)
+        os.makedirs(self.outputs_folder, exist_ok=True)
+
+        self.mover = ThreadPoolExecutor(max_workers=1)
+        self.prefetch_thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+        self.prefetch_thread.start()
+
+    def prefetch(self, input_file):
+        with self.condition:
+            self.candidates.append(input_file)
+            self.condition.notify_all()
+
+    def _prefetch_loop(self):
+        while True:
+            with self.condition:
+                while not self.closed and not (self.candidates and len(self.staging) + len(self.staged) < self.prefetch_count):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                input_file = self.candidates.popleft()
+                self.checking = input_file
+
+            try:
+                stage = not self.should_stage or self.should_stage(input_file)
+                size = os.path.getsize(input_file) if stage else 0
+            except OSError:
+                stage = False
+
+            with self.condition:
+                if stage and size <= self.budget_bytes:  # Files larger than the budget are read from the share
+                    while not self.closed and input_file not in self.cancelled and self.reserved_bytes + size > self.budget_bytes:
+                        self.condition.wait()
+                    stage = not self.closed and input_file not in self.cancelled
+                else:
+                    stage = False
+                self.checking = None
+                self.cancelled.discard(input_file)
+                if not stage:
+                    continue
+                self.reserved_bytes += size
+                self.staging[input_file] = size
+
+            local_path = os.path.join(self.inputs_folder, scratch_name(input_file))
+            try:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                fast_copy(input_file, local_path, use_hardlinks=False)
+            except OSError:
+                local_path = None
+
+            with self.condition:
+                del self.staging[input_file]
+                if local_path and input_file not in self.cancelled and not self.closed:
+                    self.staged[input_file] = (local_path, size)
+                else:
+                    self.cancelled.discard(input_file)
+                    self.reserved_bytes -= size
+                    self._remove(local_path)
+                self.condition.notify_all()
+
+    def acquire(self, input_file):
+        """Return the path to read an input from: the staged copy if there is one, otherwise the original.
+        Waits for a copy that is already in progress."""
+        with self.condition:
+            if input_file in self.candidates:
+                self.candidates.remove(input_file)  # Too late to be worth staging
+            if input_file == self.checking:
+                self.cancelled.add(input_file)  # Stops a prefetch that is waiting for budget
+            while input_file in self.staging:
+                self.condition.wait()
+            entry = self.staged.pop(input_file, None)
+            if entry is None:
+                return input_file
+            self.in_use[input_file] = entry
+            return entry[0]
+
+    def release(self, input_file):
+        """Remove the staged copy of an input once it has been encoded (or won't be)."""
+        with self.condition:
+            if input_file in self.candidates:
+                self.candidates.remove(input_file)
+            if input_file == self.checking or input_file in self.staging:
+                self.cancelled.add(input_file)  # Removed by the prefetch thread
+            entry = self.in_use.pop(input_file, None) or self.staged.pop(input_file, None)
+            if entry:
+                self.reserved_bytes -= entry[1]
+            self.condition.notify_all()
+        if entry:
+            self._remove(entry[0])
+
+    def output_path(self, input_file, output_file, estimated_size):
+        """Return where to write an output: a scratch path if the estimated size fits in the budget, otherwise output_file."""
+        with self.condition:
+            if self.closed or self.reserved_bytes + estimated_size > self.budget_bytes:
+                return output_file
+            self.reserved_bytes += estimated_size
+            scratch_output = os.path.join(self.outputs_folder, scratch_name(output_file))  # Keeps the output extension for ffmpeg
+            self.outputs[scratch_output] = estimated_size
+        os.makedirs(os.path.dirname(scratch_output), exist_ok=True)
+        return scratch_output
+
+    def discard_output(self, scratch_output):
+        with self.condition:
+            if scratch_output not in self.outputs:
+                return
+            self.reserved_bytes -= self.outputs.pop(scratch_output)
+            self.condition.notify_all()
+        shutil.rmtree(os.path.dirname(scratch_output), ignore_errors=True)
+
+    def publish(self, scratch_output, output_file, on_moved, on_failed):
+        """Move a finished output to output_file in the background, then call on_moved() or on_failed(error)."""
+        def move():
+            try:
+                try:
+                    os.replace(scratch_output, output_file)  # Same drive
+                except OSError:
+                    fast_copy(scratch_output, output_file, use_hardlinks=False)  # Written under a temporary name
+            except OSError as e:
+                self.discard_output(scratch_output)
+                on_failed(e)
+                return
+            self.discard_output(scratch_output)
+            on_moved()
+        self.mover.submit(move)
+
+    def close(self):
+        """Wait for the outputs to be moved and remove the staged inputs."""
+        self.mover.shutdown(wait=True)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.prefetch_thread.join()
+        shutil.rmtree(self.inputs_folder, ignore_errors=True)
+
+    def _remove(self, local_path):
+        if local_path:
+            shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
@@ -0,0 +1,114 @@
+import glob
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split_into_segments(input_file, work_dir, segment_seconds, loglevel="error"):
+    """Cut the first video stream into segments without re-encoding. Stream copy can only cut at
+    keyframes, so every segment starts with a keyframe and can be encoded on its own."""
+    os.makedirs(work_dir, exist_ok=True)
+    for old_path in glob.glob(os.path.join(work_dir, "*.mkv")):
+        os.remove(old_path)  # Leftovers of an interrupted split or of other settings
+    split_cmd = [
+        "ffmpeg", "-y", "-i", input_file, "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+        "-segment_format", "matroska",
+        "-loglevel", loglevel, "-hide_banner", "-nostats",
+        os.path.join(work_dir, "source_%05d.mkv")
+    ]
+    subprocess.run(split_cmd, check=True)
+    return sorted(glob.glob(os.path.join(work_dir, "source_*.mkv")))
+
+
+def encoded_segment_path(segment_path):
+    segment_folder, segment_name = os.path.split(segment_path)
+    return os.path.join(segment_folder, segment_name.replace("source_", "encoded_"))
+
+
+def partial_path(file_path):
+    # Keeps the extension, ffmpeg picks the container from it
+    path_and_name, extension = os.path.splitext(file_path)
+    return f"{path_and_name}.partial{extension}"
+
+
+def encode_segment(segment_path, video_args, loglevel="error", run=None):
+    encoded_path = encoded_segment_path(segment_path)
+    encode_cmd = [
+        "ffmpeg", "-y", "-i", segment_path, "-map", "0:v:0",
+        *video_args,
+        "-loglevel", loglevel, "-hide_banner", "-nostats",
+        partial_path(encoded_path)
+    ]
+    if run is None:
+        subprocess.run(encode_cmd, check=True)
+    else:
+        run(encode_cmd)
+    os.replace(partial_path(encoded_path), encoded_path)  # An encoded segment is never half written
+    return encoded_path
+
+
+def concat_segments(encoded_paths, input_file, output_file, work_dir, loglevel="error"):
+    """Join the encoded segments without re-encoding, and copy every other stream from the source once."""
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as list_file:
+        for encoded_path in encoded_paths:
+            escaped_path = os.path.abspath(encoded_path).replace("'", "'\\''")  # Quoting rules of the concat demuxer
+            list_file.write(f"file '{escaped_path}'\n")
+
+    concat_cmd = [
+        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-i", input_file,
+        "-map", "0:v", "-map", "1", "-map", "-1:v",  # Encoded video, then everything but video from the source
+        "-c", "copy",
+        "-loglevel", loglevel, "-hide_banner", "-nostats",
+        output_file
+    ]
+    subprocess.run(concat_cmd, check=True)
+
+
+def encode_in_segments(input_file, output_file, work_dir, video_args, segment_seconds, workers,
+                       loglevel="error", stop_requested=None, checkpoint=None, run_segment=None):
+    """Encode a file as keyframe aligned segments in parallel and join them into output_file.
+
+    With a checkpoint (see job_state.SegmentCheckpoint) the split and every encoded segment are recorded,
+    and a later call continues from the segments that were already encoded. The work folder is only
+    removed once the file is complete. Returns the number of segments and how many were reused.
+    run_segment(ffmpeg_cmd, segment_index) can replace subprocess.run for the segment encodes.
+    Raises subprocess.CalledProcessError if any step fails.
+    """
+    segments = checkpoint.split_segments() if checkpoint else None
+    if segments is None:
+        segments = split_into_segments(input_file, work_dir, segment_seconds, loglevel)
+        if not segments:
+            raise subprocess.CalledProcessError(1, "ffmpeg", "No segments were written")
+        if checkpoint:
+            checkpoint.record_split(segments)
+
+    encoded_before = checkpoint.encoded_segments() if checkpoint else set()
+    reused_segments = 0
+
+    def encode(numbered_segment):
+        nonlocal reused_segments
+        segment_index, segment_path = numbered_segment
+        encoded_path = encoded_segment_path(segment_path)
+        if segment_index in encoded_before and os.path.exists(encoded_path):
+            reused_segments += 1
+            return encoded_path
+        if stop_requested is not None and stop_requested.is_set():
+            raise subprocess.CalledProcessError(1, "ffmpeg", "Stopped")
+        run = (lambda encode_cmd: run_segment(encode_cmd, segment_index)) if run_segment else None
+        encode_segment(segment_path, video_args, loglevel, run)
+        if checkpoint:
+            checkpoint.mark_encoded(segment_index, segment_path)
+        return encoded_path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        encoded_paths = list(pool.map(encode, enumerate(segments)))
+
+    concat_segments(encoded_paths, input_file, output_file, work_dir, loglevel)
+
+    if checkpoint:
+        checkpoint.clear()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return len(segments), reused_segments
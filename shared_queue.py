@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from job_state import done_statuses
+
+
+def queue_key(input_file):
+    return hashlib.sha1(input_file.encode("utf-8")).hexdigest()
+
+
+class LeaseQueue:
+    """A job queue shared by several nodes through lease files in a folder they can all reach.
+
+    A node claims a file by creating <key>.lease with O_EXCL, which only one node can do. While the file
+    is processed the node touches the lease every heartbeat_seconds. A lease that wasn't touched for
+    lease_seconds belongs to a node that stopped, and can be taken over. When a file is finished its
+    lease is replaced by <key>.result, which tells every node the outcome.
+    """
+
+    def __init__(self, queue_folder, node_name, lease_seconds=120, heartbeat_seconds=30):
+        self.queue_folder = queue_folder
+        self.node_name = node_name
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.leases = {}  # input file -> lease path, held by this node
+        self.stop_heartbeat = threading.Event()
+        os.makedirs(queue_folder, exist_ok=True)
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self.heartbeat_thread.start()
+
+    def lease_path(self, input_file):
+        return os.path.join(self.queue_folder, queue_key(input_file) + ".lease")
+
+    def result_path(self, input_file):
+        return os.path.join(self.queue_folder, queue_key(input_file) + ".result")
+
+    def read_json(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def result(self, input_file):
+        """Return the result another run wrote for a file if it means the file should be left alone, else None.
+        Other results (errors, skipped files) only count during the run that wrote them, so they are checked
+        again on the next run, like in job_state.db."""
+        result = self.read_json(self.result_path(input_file))
+        if result is None:
+            return None
+        if result["status"] in done_statuses or result["finished_at"] >= self.started_at:
+            return result
+        return None
+
+    def lease_expired(self, lease_path):
+        try:
+            return time.time() - os.path.getmtime(lease_path) > self.lease_seconds
+        except OSError:
+            return True  # Released in the meantime
+
+    def claim(self, input_file):
+        """Try to claim a file. Returns (True, None) if this node may process it, (False, result) if it is
+        finished, and (False, None) if another node holds a live lease on it."""
+        if self.holds(input_file):
+            return True, None  # Processed again by this node, e.g. after its output failed the verification
+        result = self.result(input_file)
+        if result is not None:
+            return False, result
+
+        lease_path = self.lease_path(input_file)
+        for _ in range(2):
+            try:
+                descriptor = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                expired_lease = self.read_json(lease_path)
+                if not self.lease_expired(lease_path):
+                    return False, None
+                # Move the expired lease out of the way. Only one node can rename it, the others get an error.
+                moved_path = f"{lease_path}.expired.{self.node_name}.{time.time():.0f}"
+                try:
+                    os.rename(lease_path, moved_path)
+                except OSError:
+                    return False, None
+                # Another node may have taken over the lease, or its owner touched it, between the check and the
+                # rename. Then the live lease was moved and goes back.
+                if not self.lease_expired(moved_path) or self.read_json(moved_path) != expired_lease:
+                    self._restore_lease(moved_path, lease_path)
+                    return False, None
+                self._remove_expired(lease_path)
+                continue
+            with os.fdopen(descriptor, "w", encoding="utf-8") as lease_file:
+                json.dump({"input": input_file, "node": self.node_name, "claimed_at": time.time()}, lease_file)
+            with self.lock:
+                self.leases[input_file] = lease_path
+            return True, None
+        return False, None
+
+    def state(self, input_file):
+        """Return "done" if the file has a result, "leased" while another node works on it, otherwise "free"."""
+        if self.result(input_file) is not None:
+            return "done"
+        lease_path = self.lease_path(input_file)
+        if os.path.exists(lease_path) and not self.lease_expired(lease_path):
+            return "leased"
+        return "free"
+
+    def write_result(self, input_file, status, **details):
+        result = {"input": input_file, "status": status, "node": self.node_name, "finished_at": time.time(), **details}
+        result_path = self.result_path(input_file)
+        temporary_path = f"{result_path}.{self.node_name}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as result_file:
+            json.dump(result, result_file)
+        os.replace(temporary_path, result_path)  # Other nodes never read half a result
+
+    def finish(self, input_file, status, **details):
+        """Write the result of a claimed file and drop its lease."""
+        with self.lock:
+            lease_path = self.leases.pop(input_file, None)
+        if lease_path is None:
+            return
+        self.write_result(input_file, status, **details)
+        self._remove_lease(lease_path)
+
+    def release(self, input_file):
+        """Give up a claimed file without a result, so another node can take it right away."""
+        with self.lock:
+            lease_path = self.leases.pop(input_file, None)
+        if lease_path:
+            self._remove_lease(lease_path)
+
+    def holds(self, input_file):
+        with self.lock:
+            return input_file in self.leases
+
+    def _remove_lease(self, lease_path):
+        try:
+            os.remove(lease_path)
+        except OSError:
+            pass
+
+    def _restore_lease(self, moved_path, lease_path):
+        try:
+            os.link(moved_path, lease_path)  # Fails instead of replacing a lease created in the meantime
+        except FileExistsError:
+            pass  # Claimed again already, the owner of the moved lease notices at its next heartbeat
+        except OSError:
+            # The share doesn't support hard links
+            if not os.path.exists(lease_path):
+                try:
+                    os.rename(moved_path, lease_path)
+                except OSError:
+                    pass
+                return
+        self._remove_lease(moved_path)
+
+    def _remove_expired(self, lease_path):
+        folder, name = os.path.split(lease_path)
+        for entry in os.scandir(folder):
+            if entry.name.startswith(name + ".expired."):
+                self._remove_lease(entry.path)
+
+    def _heartbeat_loop(self):
+        while not self.stop_heartbeat.wait(self.heartbeat_seconds):
+            with self.lock:
+                leases = dict(self.leases)
+            for input_file, lease_path in leases.items():
+                lease = self.read_json(lease_path)
+                if not os.path.exists(lease_path) or (lease is not None and lease.get("node") != self.node_name):
+                    print(f"Lost the lease on {input_file} to another node, it may be encoded twice")
+                    with self.lock:
+                        self.leases.pop(input_file, None)
+                    continue
+                try:
+                    os.utime(lease_path)
+                except OSError:
+                    pass
+
+    def close(self):
+        """Stop the heartbeat and release the leases that are still held."""
+        self.stop_heartbeat.set()
+        self.heartbeat_thread.join()
+        with self.lock:
+            leases = list(self.leases.values())
+            self.leases.clear()
+        for lease_path in leases:
+            self._remove_lease(lease_path)
+
+    def summary(self):
+        """Count the results of all nodes: {"status": {status: count}, "nodes": {node: count}, "seconds": total}."""
+        statuses = {}
+        nodes = {}
+        seconds = 0
+        for entry in os.scandir(self.queue_folder):
+            if not entry.name.endswith(".result"):
+                continue
+            result = self.read_json(entry.path)
+            if result is None:
+                continue
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+            nodes[result["node"]] = nodes.get(result["node"], 0) + 1
+            seconds += result.get("seconds") or 0
+        return {"status": statuses, "nodes": nodes, "seconds": seconds}
@@ -0,0 +1,94 @@
+import os
+import shutil
+import subprocess
+import time
+
+
+def sample_starts(duration, samples, sample_seconds):
+    """Spread the sample windows evenly over the file, away from the intro and the credits."""
+    usable = duration - sample_seconds
+    return [usable * (index + 1) / (samples + 1) for index in range(samples)]
+
+
+def other_streams_bytes(probe_info, duration):
+    """Bytes of the audio and subtitles, which are copied as they are. None if they can't be told from the probe.
+
+    MKV files usually have no bitrate on their streams, then the video bitrate is taken from the overall bitrate
+    of the file (or its size) and the rest belongs to the other streams.
+    """
+    streams = probe_info.get("streams", [])
+    other_streams = [stream for stream in streams if stream.get("codec_type") != "video"]
+    if all(stream.get("bit_rate") for stream in other_streams):
+        return sum(stream["bit_rate"] for stream in other_streams) * duration / 8
+    video_bit_rates = [stream.get("bit_rate") for stream in streams if stream.get("codec_type") == "video"]
+    total_bit_rate = probe_info.get("bit_rate") or (probe_info.get("size") or 0) * 8 / duration
+    if not total_bit_rate or not video_bit_rates or not all(video_bit_rates):
+        return None
+    return max(total_bit_rate - sum(video_bit_rates), 0) * duration / 8
+
+
+def copy_other_streams(input_file, start, sample_seconds, output_path, loglevel="error"):
+    # The audio and subtitles of a sample window as they would end up in the output, 0 if they can't be copied
+    copy_cmd = [
+        "ffmpeg", "-y", "-ss", f"{start:.3f}", "-i", input_file, "-t", str(sample_seconds),
+        "-map", "0", "-map", "-0:v", "-c", "copy",
+        "-loglevel", loglevel, "-hide_banner", "-nostats",
+        output_path
+    ]
+    if subprocess.run(copy_cmd).returncode != 0 or not os.path.exists(output_path):
+        return 0
+    return os.path.getsize(output_path)
+
+
+def encode_sample(input_file, start, sample_seconds, video_args, output_path, loglevel="error"):
+    sample_cmd = [
+        "ffmpeg", "-y", "-ss", f"{start:.3f}", "-i", input_file, "-t", str(sample_seconds),
+        "-map", "0:v:0", *video_args, "-an", "-sn",
+        "-loglevel", loglevel, "-hide_banner", "-nostats",
+        output_path
+    ]
+    subprocess.run(sample_cmd, check=True)
+    return os.path.getsize(output_path)
+
+
+def predict_output(input_file, probe_info, video_args, work_dir, samples=3, sample_seconds=10, loglevel="error"):
+    """Encode a few short windows of a file and extrapolate the size and encode time of the whole file.
+
+    Returns a dict with predicted_size (bytes) and predicted_seconds, or None if the file is too short or
+    its duration is unknown. Raises subprocess.CalledProcessError if a sample can't be encoded.
+    """
+    duration = probe_info.get("duration")
+    if not duration or duration < samples * sample_seconds * 2:
+        return None  # Sampling would take about as long as the real encode
+
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        sampled_bytes = 0
+        start_time = time.time()
+        for index, start in enumerate(sample_starts(duration, samples, sample_seconds)):
+            sampled_bytes += encode_sample(input_file, start, sample_seconds, video_args,
+                                           os.path.join(work_dir, f"sample_{index}.mkv"), loglevel)
+        encode_seconds = time.time() - start_time
+
+        sampled_seconds = samples * sample_seconds
+        other_bytes = other_streams_bytes(probe_info, duration)
+        if other_bytes is None:
+            # Measure them instead, copying a stream costs a fraction of encoding it
+            copied_bytes = sum(copy_other_streams(input_file, start, sample_seconds,
+                                                  os.path.join(work_dir, f"other_{index}.mkv"), loglevel)
+                               for index, start in enumerate(sample_starts(duration, samples, sample_seconds)))
+            other_bytes = copied_bytes / sampled_seconds * duration
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "predicted_size": int(sampled_bytes / sampled_seconds * duration + other_bytes),
+        "predicted_seconds": encode_seconds / sampled_seconds * duration,
+    }
+
+
+def predicted_savings(input_size, predicted_size):
+    """Return the predicted savings as a percentage of the input size."""
+    if not input_size:
+        return 0.0
+    return (input_size - predicted_size) / input_size * 100